@@ -2,6 +2,8 @@ from abc import ABC, abstractmethod
 import os
 import time
 import subprocess
+import sys
+import shutil
 from threading import Thread
 import logging
 import paramiko
@@ -10,23 +12,27 @@ from autobuild.machine import Machine, MachineLocalProxmox
 from autobuild.texmacsmachine import TexmacsMachine
 from autobuild.texmacsrepo import TexmacsSVN, TexmacsOBS, get_global_texmacs_svn, get_global_texmacs_obs
 from autobuild.utils import system_remote, launch_command
+from autobuild.scheduler import get_global_scheduler, estimate_makespan
+from autobuild.treecache import get_global_tree_cache
+from autobuild.daemon import Daemon
+from autobuild.template import TemplateEngine, file_digests
+from autobuild.openbuildservice import failed_results
+from autobuild.metrics import get_global_metrics
+from autobuild.logs import configure_logging
+from autobuild.ssh import get_global_ssh_pool
 
 class TexmacsMachineMac(TexmacsMachine):
 
     def __init__(self, name, ip, username, machine, tmrepo="/Users/*username*/DEV/SDK"):
         super().__init__(name, ip, username, machine)
+        self.patch_dir = "patchs/patchmac"
         self.tmrepo = tmrepo.replace("*username*", self.username)
     
     def duplicate_and_copy_patch(self):
-        self.system("mkdir -p patched")
-        self.patched_dir = "patched/" + self.name
-        svn = get_global_texmacs_svn()
-        self.system("rm -rf " + self.patched_dir)
-        svn.duplicate_and_copy_patch(self.patched_dir, "patchs/patchmac")
+        self.prepare_patched_tree()
     
     def copy_src_to_remote(self):
-        self.launch_ssh_command("rm -rf /Users/" + self.username + "/DEV/texmacs")
-        self.copy_host_to_remote(self.patched_dir + "/*", "/Users/" + self.username + "/DEV/texmacs")
+        self.sync_src_to_remote("/Users/" + self.username + "/DEV/texmacs")
     
     def build_package(self):
         commands = [
@@ -35,12 +41,14 @@ class TexmacsMachineMac(TexmacsMachine):
             "cd DEV",
             "rm -rf distr/*",
             "cd texmacs",
-            "make distclean",
-            "PKG_CONFIG_PATH=/Users/" + self.username + "/DEV/SDK/lib/pkgconfig ./configure --with-tmrepo=" + self.tmrepo,
+        ]
+        commands += self.configure_commands("PKG_CONFIG_PATH=/Users/" + self.username + "/DEV/SDK/lib/pkgconfig ./configure --with-tmrepo=" + self.tmrepo, ["make distclean || true"])
+        commands += [
             "make",
             "make PACKAGE",
         ]
-        self.launch_ssh_commands(commands)
+        self.launch_ssh_commands(commands, check=True, keep_output=False)
+        self.save_configure_fingerprint()
     
     def copy_packages_from_remote(self):
         self.system("mkdir -p distr")
@@ -68,23 +76,15 @@ class TexmacsMachineWin(TexmacsMachine):
 
     def __init__(self, name, ip, username, machine):
         super().__init__(name, ip, username, machine)
+        self.patch_dir = "patchs/patchwin"
         self.set_default_shell("C:\\msys64\\niv2\\msys2_shell.cmd -mingw32 -defterm -no-start -here")
         self.set_default_rsync("C:\\msys64\\usr\\bin\\rsync.exe")
     
     def duplicate_and_copy_patch(self):
-        svn = get_global_texmacs_svn()
-        os.system("mkdir -p patched")
-        self.patched_dir = "patched/" + self.name
-        self.system("rm -rf " + self.patched_dir)
-        svn.duplicate_and_copy_patch(self.patched_dir, "patchs/patchwin")
+        self.prepare_patched_tree()
     
     def copy_src_to_remote(self):
-        commands = [
-            "cd /c/msys64/niv2/home/magix",
-            "rm -rf texmacs",
-        ]
-        self.launch_ssh_commands(commands)
-        self.copy_host_to_remote(self.patched_dir + "/*", "/c/msys64/niv2/home/magix/texmacs")
+        self.sync_src_to_remote("/c/msys64/niv2/home/magix/texmacs")
 
     def build_package(self):
         commands = [
@@ -93,11 +93,14 @@ class TexmacsMachineWin(TexmacsMachine):
             "export with_sparkle=/WinSparkle-0.6.0",
             "rm -rf distr",
             "cd texmacs",
-            "./configure --with-tmrepo=/SDK --with-qt=/Qt",
+        ]
+        commands += self.configure_commands("./configure --with-tmrepo=/SDK --with-qt=/Qt")
+        commands += [
             "make",
             "make PACKAGE",
         ]
-        self.launch_ssh_commands(commands)
+        self.launch_ssh_commands(commands, check=True, keep_output=False)
+        self.save_configure_fingerprint()
             
     def copy_packages_from_remote(self):
         self.system("mkdir -p distr")
@@ -123,54 +126,68 @@ class TexmacsMachineOBS(TexmacsMachine):
 
     def __init__(self):
         super().__init__("obs", "obs", "obs", Machine("obs"))
+        self.patch_dir = "patchs/patchobs"
     
     def duplicate_and_copy_patch(self):
-        # Create patched .tar.gz
+        # Create patched .tar.gz, or take it and its checksums from the cache of patched trees
         svn = get_global_texmacs_svn()
-        os.system("mkdir -p patched")
-        self.patched_dir = "patched/" + self.name
-        self.system("rm -rf " + self.patched_dir)
-        patched = svn.duplicate_and_copy_patch(self.patched_dir, "patchs/patchobs")
+        cache = get_global_tree_cache()
+        patched = self.prepare_patched_tree()
         self.filename = "TeXmacs-" + svn.version + ".tar.gz"
-        patched.make_tgz("TeXmacs-" + svn.version)
-
-        # Compute checksums
-        checksums_sha1 = self.system("sha1sum " + self.filename)
-        checksums_sha1 = checksums_sha1.split(" ")[0]
-        checksums_sha256 = self.system("sha256sum " + self.filename)
-        checksums_sha256 = checksums_sha256.split(" ")[0]
-        md5sum = self.system("md5sum " + self.filename)
-        md5sum = md5sum.split(" ")[0]
-        file_size = self.system("stat -c %s " + self.filename)
-        file_size = file_size.replace("\n", "")
+        self.tarball = self.filename
+        meta = None
+        if self.patched_key is not None:
+            self.tarball = os.path.join(cache.entry_path(self.patched_key), self.filename)
+            meta = cache.get_meta(self.patched_key)
+
+        # the date of the entries, the tarballs cached before it was recorded are made again
+        # the patched tree has no .svn, the date comes from the working copy
+        mtime = svn.last_changed_time()
+        if meta is not None and meta.get("tarball") == self.filename and meta.get("tarball_mtime") == mtime and os.path.isfile(self.tarball):
+            self.log_info("", "Reusing " + self.tarball)
+            checksums = meta["checksums"]
+        else:
+            patched.make_tgz("TeXmacs-" + svn.version, self.tarball, mtime=mtime)
+
+            # Compute checksums, in a single pass over the tarball
+            checksums = file_digests(self.tarball)
+            if self.patched_key is not None:
+                cache.update(self.patched_key, tarball=self.filename, tarball_mtime=mtime, checksums=checksums)
 
         # Remove old .tar.gz
         obs = get_global_texmacs_obs()
         self.system("rm -rf " + obs.dst + "/TeXmac*/*.tar.gz")
 
         # List recursively all files in obs.dst-template. Copy them to obs.dst and replace existing files
-        self.system("cp -R " + obs.dst + "-template" + "/* " + obs.dst)
+        for name in os.listdir(obs.dst + "-template"):
+            if name.startswith("."):
+                continue
+            path = os.path.join(obs.dst + "-template", name)
+            if os.path.isdir(path):
+                shutil.copytree(path, os.path.join(obs.dst, name), dirs_exist_ok=True)
+            else:
+                shutil.copy2(path, obs.dst)
 
         # Walk through obs.dst and replace file named by __TGZ__ with the new .tar.gz
         for root, dirs, files in os.walk(obs.dst):
             for file in files:
                 if file == "__TGZ__":
-                    self.system("cp " + self.filename + " " + root + "/" + self.filename)
-                    self.system("rm -rf " + root + "/__TGZ__")
+                    shutil.copyfile(self.tarball, os.path.join(root, self.filename))
+                    os.remove(os.path.join(root, "__TGZ__"))
         
-        # Walk through obs.dst and replace file content with __VERSION__ by the new version
-        for root, dirs, files in os.walk(obs.dst):
-            for file in files:
-                if file.endswith(".tar.tz"):
-                    continue
-                self.system("sed -i 's/__VERSION__/" + svn.version + "/g' " + root + "/" + file)
-                self.system("sed -i 's/__SHA1__/" + checksums_sha1 + "/g' " + root + "/" + file)
-                self.system("sed -i 's/__SHA256__/" + checksums_sha256 + "/g' " + root + "/" + file)
-                self.system("sed -i 's/__MD5__/" + md5sum + "/g' " + root + "/" + file)
-                self.system("sed -i 's/__SIZE__/" + file_size + "/g' " + root + "/" + file)
+        # Walk through obs.dst and replace __VERSION__, __SHA1__, ... in the content of the files
+        engine = TemplateEngine({
+            "__VERSION__": svn.version,
+            "__SHA1__": checksums["sha1"],
+            "__SHA256__": checksums["sha256"],
+            "__MD5__": checksums["md5"],
+            "__SIZE__": checksums["size"],
+        })
+        self.log_debug("", "Rendered " + str(engine.render_tree(obs.dst)) + " files in " + obs.dst)
         
-        # Remove generated .tar.gz
-        self.system("rm -rf " + self.filename)
+        # Remove generated .tar.gz, unless it is kept in the cache
+        if self.patched_key is None:
+            self.system("rm -rf " + self.filename)
             
     def copy_src_to_remote(self):
         texmacs_obs = get_global_texmacs_obs()
@@ -179,18 +196,27 @@ class TexmacsMachineOBS(TexmacsMachine):
     def build_package(self):
         texmacs_obs = get_global_texmacs_obs()
         texmacs_obs.commit()
-        self.log_debug("", "Waiting for 120 secondes for the build to finish")
-        time.sleep(120)
-        while texmacs_obs.is_building():
-            self.log_debug("", "Still building. Waiting for 60 seconds")
-            time.sleep(60)
-        self.log_info("", texmacs_obs.get_results())
+        self.log_debug("", "Waiting for the builds to finish")
+        table = texmacs_obs.wait_for_results()
+        for target in sorted(table):
+            self.log_info("", target + " " + table[target])
+        self.failed_repositories = failed_results(table)
+        if len(self.failed_repositories) > 0:
+            self.log_error("", "Failed builds: " + ", ".join(self.failed_repositories))
     
     def copy_packages_from_remote(self):
+        # binaries already downloaded and unchanged on OBS are kept
         self.system("mkdir -p distr")
-        self.system("rm -rf distr/" + self.name)
         obs = get_global_texmacs_obs()
-        obs.download_binaries("TeXmacs-QT5", "distr", self.logger)
+        self.download_results = obs.download_binaries("TeXmacs-QT5", "distr/" + self.name, self.logger)
+        failed = []
+        for name, result in sorted(self.download_results.items()):
+            if result["status"] == "failed":
+                self.log_error("", "Failed to download binaries for " + name)
+                failed.append(name)
+        # a partial download must not be recorded as the artifacts of this revision
+        if len(failed) > 0:
+            raise RuntimeError("Failed to download binaries for " + ", ".join(failed))
 
     def test_package(self):
         pass
@@ -200,28 +226,27 @@ class TexmacsMachineLinux(TexmacsMachine):
 
     def __init__(self, name, ip, username, machine):
         super().__init__(name, ip, username, machine)
+        self.patch_dir = "patchs/patchubu16static"
     
     def duplicate_and_copy_patch(self):
-        self.system("mkdir -p patched")
-        self.patched_dir = "patched/" + self.name
-        svn = get_global_texmacs_svn()
-        self.system("rm -rf " + self.patched_dir)
-        svn.duplicate_and_copy_patch(self.patched_dir, "patchs/patchubu16static")
+        self.prepare_patched_tree()
     
     def copy_src_to_remote(self):
-        self.launch_ssh_command("rm -rf /home/" + self.username + "/DEV/texmacs")
-        self.copy_host_to_remote(self.patched_dir + "/*", "/home/" + self.username + "/DEV/texmacs")
+        self.sync_src_to_remote("/home/" + self.username + "/DEV/texmacs")
     
     def build_package(self):
         commands = [
             "cd DEV",
             "rm -rf distr/*",
             "cd texmacs",
-            "./configure --with-tmrepo=/home/magix/DEV/SDK",
+        ]
+        commands += self.configure_commands("./configure --with-tmrepo=/home/magix/DEV/SDK")
+        commands += [
             "make",
             "make PACKAGE",
         ]
-        self.launch_ssh_commands(commands)
+        self.launch_ssh_commands(commands, check=True, keep_output=False)
+        self.save_configure_fingerprint()
     
     def copy_packages_from_remote(self):
         self.system("mkdir -p distr")
@@ -250,17 +275,13 @@ class TexmacsMachineAndroid(TexmacsMachine):
 
     def __init__(self, name, ip, username, machine):
         super().__init__(name, ip, username, machine)
+        self.patch_dir = "patchs/patchandroid"
 
     def duplicate_and_copy_patch(self):
-        self.system("mkdir -p patched")
-        self.patched_dir = "patched/" + self.name
-        svn = get_global_texmacs_svn()
-        self.system("rm -rf " + self.patched_dir)
-        svn.duplicate_and_copy_patch(self.patched_dir, "patchs/patchandroid")
+        self.prepare_patched_tree()
 
     def copy_src_to_remote(self):
-        self.launch_ssh_command("rm -rf /home/" + self.username + "/DEV/texmacs/src")
-        self.copy_host_to_remote(self.patched_dir + "/*", "/home/" + self.username + "/DEV/texmacs/src")
+        self.sync_src_to_remote("/home/" + self.username + "/DEV/texmacs/src")
 
     def build_package(self):
         commands = [
@@ -268,7 +289,7 @@ class TexmacsMachineAndroid(TexmacsMachine):
             "source set-devel-path",
             "make texmacs",
         ]
-        self.launch_ssh_commands(commands)
+        self.launch_ssh_commands(commands, check=True, keep_output=False)
 
     def copy_packages_from_remote(self):
         self.system("mkdir -p distr")
@@ -364,8 +385,11 @@ def create_patch(local_dir, ip, username, remote_dir, patch_dir):
 
 #os.system("rm -rf logs repos/home:jmnotin:TeXmacs repos/texmacs patched distr")
 
+# build logs are rotated every 100 MB, keeping 5 gzipped archives
+log_pipeline = configure_logging(max_bytes=100 * 1024 * 1024, backup_count=5, compress=True)
+
 machines = {
-    "proxmox": MachineLocalProxmox(),
+    "proxmox": MachineLocalProxmox(cpus=16, ram=64),
     "macm1": Machine("macm1"),
     "macintel": Machine("macintel"),
     "castafiore": Machine("castafiore"),
@@ -381,18 +405,76 @@ texmacs_build_systems = [
   #TexmacsMachineAndroid("Android", "192.168.200.107", "magix", machines["proxmox"]),
 ]
 
+# resources (cpus, ram in GB) of the virtual machines, so that several of them can run on their host
+machine_resources = {
+    "ubu16static": (4, 8),
+    "Windows11": (8, 16),
+    "Android": (4, 8),
+}
+for machine in texmacs_build_systems:
+    if machine.name in machine_resources:
+        machine.set_resources(*machine_resources[machine.name])
 
-get_global_texmacs_obs()
 
+get_global_texmacs_obs()
 
-for machine in texmacs_build_systems:
-    machine.build()
+if "--daemon" in sys.argv:
+    # long running mode, building on new revisions
+    Daemon(texmacs_build_systems).run()
+else:
+    # machines whose artifacts for the current revision and patch already exist are skipped
+    outdated_build_systems = []
+    for machine in texmacs_build_systems:
+        if machine.is_up_to_date():
+            print("Artifacts of " + machine.name + " are up to date, skipping")
+        else:
+            outdated_build_systems.append(machine)
+
+    # longest jobs first, and an estimation of when everything will be done from the previous durations
+    outdated_build_systems.sort(key=lambda machine: machine.estimate_duration(), reverse=True)
+    hosts = {}
+    for machine in outdated_build_systems:
+        hosts.setdefault(machine.machine, []).append((machine.estimate_duration(), machine.cpus))
+    makespan = max([estimate_makespan(jobs, host.cpus) for host, jobs in hosts.items()] + [0])
+    print("Estimated completion in " + str(round(makespan / 60)) + " minutes, at " + time.strftime("%H:%M", time.localtime(time.time() + makespan)))
+
+    jobs = []
+    for machine in outdated_build_systems:
+        jobs.append((machine, "build", machine.build()))
     
-for machine in texmacs_build_systems:
-    machine.test()
-
-for machine in texmacs_build_systems:
-    machine.wait()
-
-for machine in texmacs_build_systems:
-    machine.join()
\ No newline at end of file
+    for machine in outdated_build_systems:
+        jobs.append((machine, "test", machine.test()))
+
+    for machine in outdated_build_systems:
+        machine.wait()
+
+    # the tracebacks are in the logs of the machines, only a line per failed job here
+    failed = []
+    build_errors = {}
+    for machine, name, future in jobs:
+        if future.cancelled():
+            failed.append(machine.name + " " + name + ": cancelled")
+            continue
+        error = future.exception()
+        if error is None:
+            continue
+        if name == "build":
+            build_errors[machine.name] = error
+            failed.append(machine.name + " build: " + (str(error).splitlines() or [type(error).__name__])[0])
+        elif build_errors.get(machine.name) is error:
+            failed.append(machine.name + " test: skipped, the build failed")
+        else:
+            failed.append(machine.name + " test: " + (str(error).splitlines() or [type(error).__name__])[0])
+
+    get_global_scheduler().shutdown()
+    get_global_ssh_pool().close()
+    print("Metrics written to " + get_global_metrics().write())
+    log_pipeline.stop()
+    for machine in machines.values():
+        machine.shutdown_idle()
+
+    for line in failed:
+        print("FAILED " + line)
+    if len(failed) > 0:
+        print(str(len(failed)) + " jobs failed, see logs/build_<machine>.log")
+        sys.exit(1)
@@ -0,0 +1,121 @@
+import os
+import json
+import time
+import tempfile
+from threading import Lock
+
+from autobuild.texmacsrepo import get_global_texmacs_svn
+from autobuild.metrics import reset_global_metrics
+
+class Daemon:
+
+    def __init__(self, build_systems, interval = 60, quiet_period = 600, state_path = "state/daemon.json"):
+        # interval: seconds between two checks of the remote revision
+        # quiet_period: seconds without new commit before building, so that bursts of commits give one build
+        self.build_systems = build_systems
+        self.interval = interval
+        self.quiet_period = quiet_period
+        self.state_path = state_path
+        self.status = "starting"
+        self.remote_revision = ""
+        self.last_change = 0
+        self.last_check = 0
+        self.last_build = 0
+        self.futures = {}
+        self.metrics_written = True
+        # write_state is also called from the scheduler threads, when a test ends
+        self.state_mutex = Lock()
+
+    def __str__(self):
+        return "Daemon: " + self.status
+
+    def get_machine_status(self, machine):
+        if machine.name not in self.futures:
+            return "up to date"
+        future = self.futures[machine.name]
+        if not future.done():
+            return "building"
+        if future.cancelled() or future.exception() is not None:
+            return "failed"
+        return "done"
+
+    def is_building(self):
+        return any([not future.done() for future in self.futures.values()])
+
+    def write_state(self):
+        svn = get_global_texmacs_svn()
+        state = {
+            "status": self.status,
+            "local_revision": svn.revision,
+            "remote_revision": self.remote_revision,
+            "version": svn.version,
+            "last_change": self.last_change,
+            "last_check": self.last_check,
+            "last_build": self.last_build,
+            "machines": {machine.name: self.get_machine_status(machine) for machine in self.build_systems},
+        }
+        with self.state_mutex:
+            os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+            fd, path = tempfile.mkstemp(dir=os.path.dirname(self.state_path), suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                json.dump(state, f, indent=1)
+            # mkstemp creates the file readable by its owner only
+            os.chmod(path, 0o644)
+            os.replace(path, self.state_path)
+
+    def build_outdated(self):
+        # only the machines whose artifacts do not match the current revision and patches are built
+        reset_global_metrics()
+        self.futures = {}
+        for machine in sorted(self.build_systems, key=lambda machine: machine.estimate_duration(), reverse=True):
+            if machine.is_up_to_date():
+                continue
+            print("Scheduling build of " + machine.name)
+            machine.build()
+            self.futures[machine.name] = machine.test(lambda future: self.write_state())
+        self.last_build = time.time()
+        self.metrics_written = False
+
+    def poll(self):
+        svn = get_global_texmacs_svn()
+        self.last_check = time.time()
+        remote_revision = svn.remote_revision()
+        if remote_revision == "":
+            self.status = "svn unreachable"
+            return
+        if remote_revision != self.remote_revision:
+            self.remote_revision = remote_revision
+            self.last_change = time.time()
+
+        if self.is_building():
+            self.status = "building"
+            return
+        if not self.metrics_written:
+            # report of the builds that just ended
+            print("Metrics written to " + reset_global_metrics().write())
+            self.metrics_written = True
+
+        if remote_revision == svn.last_changed_revision():
+            self.status = "idle"
+        elif time.time() - self.last_change < self.quiet_period:
+            self.status = "waiting for commits to settle"
+        else:
+            print("New revision " + remote_revision + " available")
+            svn.up()
+            self.build_outdated()
+            self.status = "building"
+
+    def run(self):
+        get_global_texmacs_svn()
+        self.build_outdated()
+        while True:
+            try:
+                self.poll()
+            except Exception as e:
+                print("Error: " + str(e))
+                self.status = "error: " + str(e)
+            try:
+                self.write_state()
+            except Exception as e:
+                print("Error: failed to write " + self.state_path + ": " + str(e))
+            time.sleep(self.interval)
@@ -0,0 +1,224 @@
+import os
+import gzip
+import time
+import queue
+import shutil
+import logging
+import logging.handlers
+from threading import Lock
+
+LOG_FORMAT = "%(asctime)s - %(machine)s - %(phase)s - r%(revision)s - %(levelname)s - %(prefix)s - %(message)s"
+
+def gzip_rotator(source, dest):
+    with open(source, "rb") as f_in:
+        with gzip.open(dest, "wb") as f_out:
+            shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+
+class LineBatcher:
+    # gathers lines and logs them together, every size lines or interval seconds, instead of one record per line
+
+    def __init__(self, log, size = 200, interval = 0.5):
+        self.log = log
+        self.size = size
+        self.interval = interval
+        self.lines = []
+        self.last = time.time()
+
+    def add(self, line):
+        self.lines.append(line)
+        if len(self.lines) >= self.size or time.time() - self.last >= self.interval:
+            self.flush()
+
+    def flush(self):
+        if len(self.lines) > 0:
+            self.log("\n".join(self.lines))
+        self.lines = []
+        self.last = time.time()
+
+
+class ContextFilter(logging.Filter):
+    # adds the fields of context (machine, phase, revision) to the records of a logger
+
+    def __init__(self, context):
+        super().__init__()
+        self.context = context
+
+    def filter(self, record):
+        for key, value in self.context.items():
+            if not hasattr(record, key):
+                setattr(record, key, value)
+        if not hasattr(record, "prefix"):
+            record.prefix = ""
+        return True
+
+
+class BatchingFileHandler(logging.handlers.RotatingFileHandler):
+    # writes the records without flushing each one, the listener flushes when it is idle
+
+    def __init__(self, filename, max_bytes = 0, backup_count = 0, compress = False, flush_count = 1000):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+        self.flush_count = flush_count
+        self.pending = 0
+        if compress:
+            self.namer = lambda name: name + ".gz"
+            self.rotator = gzip_rotator
+
+    def emit(self, record):
+        try:
+            if self.shouldRollover(record):
+                self.doRollover()
+            if self.stream is None:
+                self.stream = self._open()
+            self.stream.write(self.format(record) + self.terminator)
+            self.pending += 1
+            if self.pending >= self.flush_count:
+                self.flush()
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        self.pending = 0
+        super().flush()
+
+
+class MachineFileHandler(logging.Handler):
+    # dispatches the records to <directory>/build_<machine>.log
+
+    def __init__(self, directory = "logs", max_bytes = 0, backup_count = 0, compress = False):
+        super().__init__()
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.compress = compress
+        self.handlers = {}
+        self.formatter = logging.Formatter(LOG_FORMAT)
+
+    def emit(self, record):
+        # an error must not stop the listener thread, the only one writing the logs
+        try:
+            machine = getattr(record, "machine", "")
+            if machine not in self.handlers:
+                os.makedirs(self.directory, exist_ok=True)
+                handler = BatchingFileHandler(os.path.join(self.directory, "build_" + machine + ".log"), self.max_bytes, self.backup_count, self.compress)
+                handler.setFormatter(self.formatter)
+                self.handlers[machine] = handler
+            self.handlers[machine].handle(record)
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        for handler in self.handlers.values():
+            handler.flush()
+
+    def close(self):
+        for handler in self.handlers.values():
+            handler.close()
+        super().close()
+
+
+class LiveHandler(logging.Handler):
+    # calls the subscribed callbacks with the formatted records of their machine
+
+    def __init__(self):
+        super().__init__()
+        self.subscribers = []
+        self.mutex = Lock()
+        self.formatter = logging.Formatter(LOG_FORMAT)
+
+    def subscribe(self, machine, callback):
+        # machine None for all the machines, returns a function to unsubscribe
+        subscriber = (machine, callback)
+        with self.mutex:
+            self.subscribers.append(subscriber)
+        def unsubscribe():
+            with self.mutex:
+                if subscriber in self.subscribers:
+                    self.subscribers.remove(subscriber)
+        return unsubscribe
+
+    def emit(self, record):
+        with self.mutex:
+            subscribers = list(self.subscribers)
+        if len(subscribers) == 0:
+            return
+        try:
+            line = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+        for subscriber in subscribers:
+            machine, callback = subscriber
+            if machine is None or machine == getattr(record, "machine", ""):
+                try:
+                    callback(line)
+                except Exception:
+                    # a failing subscriber is dropped, the other ones and the log files keep going
+                    self.handleError(record)
+                    with self.mutex:
+                        if subscriber in self.subscribers:
+                            self.subscribers.remove(subscriber)
+
+
+class LogListener(logging.handlers.QueueListener):
+    # flushes the handlers whenever no record arrived for flush_interval seconds
+
+    def __init__(self, log_queue, *handlers, flush_interval = 0.5):
+        super().__init__(log_queue, *handlers)
+        self.flush_interval = flush_interval
+
+    def dequeue(self, block):
+        while True:
+            try:
+                return self.queue.get(block, self.flush_interval)
+            except queue.Empty:
+                for handler in self.handlers:
+                    handler.flush()
+
+
+class LogPipeline:
+    # the machines log into a queue, a single thread formats and writes the records
+
+    def __init__(self, directory = "logs", max_bytes = 0, backup_count = 0, compress = False):
+        self.queue = queue.Queue()
+        self.files = MachineFileHandler(directory, max_bytes, backup_count, compress)
+        self.live = LiveHandler()
+        self.listener = LogListener(self.queue, self.files, self.live)
+        self.listener.start()
+
+    def get_logger(self, name, context):
+        # context: dict of the fields added to every record, it can be updated afterwards
+        logger = logging.getLogger(name)
+        logger.setLevel(logging.DEBUG)
+        logger.propagate = False
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+        for log_filter in list(logger.filters):
+            logger.removeFilter(log_filter)
+        logger.addFilter(ContextFilter(context))
+        logger.addHandler(logging.handlers.QueueHandler(self.queue))
+        return logger
+
+    def subscribe(self, machine, callback):
+        return self.live.subscribe(machine, callback)
+
+    def stop(self):
+        self.listener.stop()
+        self.files.flush()
+
+
+log_pipeline = None
+log_pipeline_mutex = Lock()
+
+def configure_logging(directory = "logs", max_bytes = 0, backup_count = 0, compress = False):
+    # must be called before the first machine is created to take effect
+    global log_pipeline_mutex
+    with log_pipeline_mutex:
+        global log_pipeline
+        if log_pipeline is None:
+            log_pipeline = LogPipeline(directory, max_bytes, backup_count, compress)
+        return log_pipeline
+
+def get_global_log_pipeline():
+    return configure_logging()
@@ -1,80 +1,200 @@
-from threading import Lock
+from threading import Lock, Timer, Condition
 import os
-from autobuild.utils import system_remote
 import time
+import shlex
+import itertools
+from autobuild.utils import system_remote, launch_command, wait_for_ssh
 
 class Machine:
 
-    def __init__(self, name):
+    def __init__(self, name, cpus=1, ram=0):
+        # cpus and ram (in GB, 0 to not account for it) available on the host for jobs
+        # with the defaults, a single job runs on the host at a time
         self.name = name
-        self.lock = Lock()
+        self.cpus = cpus
+        self.ram = ram
+        self.used_cpus = 0
+        self.used_ram = 0
+        self.allocations = {}
+        # ram still held by an idle guest, per ip, until it is shut down
+        self.reserved = {}
+        self.waiting = []
+        self.tickets = itertools.count()
+        self.condition = Condition()
+
+    def fits(self, cpus, ram):
+        return self.used_cpus + cpus <= self.cpus and (self.ram == 0 or self.used_ram + ram <= self.ram)
     
-    def use(self, ip=None):
-        self.lock.acquire()
+    def use(self, ip=None, cpus=1, ram=0, priority=0):
+        # wait until the host has cpus and ram available for the job
+        # waiting jobs are served by decreasing priority (their expected duration), then in arrival order
+        cpus = min(cpus, self.cpus)
+        ram = min(ram, self.ram)
+        with self.condition:
+            ticket = (-priority, next(self.tickets))
+            self.waiting.append(ticket)
+            self.waiting.sort()
+            # the ram reserved by the idle guest of ip goes to the job
+            while self.waiting[0] != ticket or not self.fits(cpus, ram - self.reserved.get(ip, 0)):
+                self.condition.wait()
+            self.waiting.pop(0)
+            self.used_cpus += cpus
+            self.used_ram += ram - self.reserved.pop(ip, 0)
+            self.allocations.setdefault(ip, []).append((cpus, ram))
+            self.condition.notify_all()
 
-    def release(self, ip=None):
-        self.lock.release()
+    def release(self, ip=None, reserve=False):
+        # with reserve, the ram stays used until unreserve(ip), for a guest kept running
+        with self.condition:
+            cpus, ram = self.allocations[ip].pop()
+            self.used_cpus -= cpus
+            if reserve:
+                self.reserved[ip] = self.reserved.get(ip, 0) + ram
+            else:
+                self.used_ram -= ram
+            self.condition.notify_all()
+
+    def unreserve(self, ip=None):
+        with self.condition:
+            self.used_ram -= self.reserved.pop(ip, 0)
+            self.condition.notify_all()
+
+    def shutdown_idle(self):
+        pass
     
 
+class VMLease:
+
+    def __init__(self, vmid, ip):
+        self.vmid = vmid
+        self.ip = ip
+        self.refs = 0
+        # the guest was started by us, and will be shut down once idle
+        self.started = False
+        self.timer = None
+        self.lock = Lock()
+
+    def __str__(self):
+        return "VMLease: " + self.vmid + " (" + str(self.refs) + " users)"
+
+
+# start the guest (virtual machine or container) if it is not running, and print its type and status
+PVE_START = 'if qm status {id} >/dev/null 2>&1; then T=qm; else T=pct; fi; S=$($T status {id}); echo "$T $S"; case "$S" in *running*) ;; *) $T start {id};; esac'
+PVE_SHUTDOWN = 'if qm status {id} >/dev/null 2>&1; then T=qm; else T=pct; fi; $T shutdown {id}'
+PVE_STATUS = 'if qm status {id} >/dev/null 2>&1; then T=qm; else T=pct; fi; $T status {id}'
+
 class MachineLocalProxmox(Machine):
 
-    def __init__(self):
-        super().__init__("local_proxmox")
-    
-    def use(self, ip=None):
-        super().use(ip)
-        
-        # take the last digit of the ip
-        full_ip = ip
-        ip = ip.split(".")[-1]
-
-        # check if the vm is already running
-        status = system_remote("qm status " + ip, "127.0.0.1", "root") + system_remote("pct status " + ip, "127.0.0.1", "root")
-        print(status)
-        if "running" in status:
-            # if it is
-            self.to_release = False
-        else:
-            # if not, start it
-            res = system_remote("qm start " + ip, "127.0.0.1", "root")
-            print(res)
-            res = system_remote("pct start " + ip, "127.0.0.1", "root")
-            print(res)
-            self.to_release = True
-        
-        # while the ip is not reachable
-        while os.system("ping -c 1 " + full_ip) != 0:
-            print("waiting for " + full_ip)
-            time.sleep(10)
+    def __init__(self, cpus=1, ram=0, timeout=600, idle_window=600):
+        # idle_window: seconds a guest started by us is kept running after its last user released it
+        super().__init__("local_proxmox", cpus, ram)
+        self.timeout = timeout
+        self.idle_window = idle_window
+        self.leases = {}
+        self.leases_mutex = Lock()
+
+    def pve(self, script):
+        # run script on the proxmox host, directly when running as root there, in a single ssh call otherwise
+        if os.geteuid() == 0:
+            return launch_command(script)
+        return system_remote(shlex.quote(script), "127.0.0.1", "root")
+
+    def get_status(self, vmid):
+        return self.pve(PVE_STATUS.format(id=vmid))
+
+    def get_lease(self, ip):
+        with self.leases_mutex:
+            if ip not in self.leases:
+                # take the last digit of the ip
+                self.leases[ip] = VMLease(ip.split(".")[-1], ip)
+            return self.leases[ip]
+
+    def use(self, ip=None, cpus=1, ram=0, priority=0):
+        super().use(ip, cpus, ram, priority)
+        lease = self.get_lease(ip)
+        with lease.lock:
+            if lease.timer is not None:
+                lease.timer.cancel()
+                lease.timer = None
+            lease.refs += 1
+            if lease.refs == 1:
+                # start the vm if it is not already running
+                status = self.pve(PVE_START.format(id=lease.vmid))
+                print(status)
+                if "running" not in status.split("\n")[0]:
+                    lease.started = True
+
+            # wait for sshd rather than for ping, a guest answers ping long before it accepts connections
+            if not wait_for_ssh(ip, timeout=self.timeout):
+                # a guest started here is shut down after the idle window, as after a normal release
+                super().release(ip, self._drop_lease(lease))
+                raise RuntimeError("Timeout while waiting for ssh on " + ip)
 
         print("ready")
 
         # enjoy !
+
+    def shutdown(self, lease):
+        # called with lease.lock held
+        res = self.pve(PVE_SHUTDOWN.format(id=lease.vmid))
+        print(res)
+
+        # wait for the guest to be stopped
+        start = time.time()
+        delay = 0.5
+        while "stopped" not in self.get_status(lease.vmid) and time.time() - start < self.timeout:
+            time.sleep(delay)
+            delay = min(delay * 2, 5)
+        lease.started = False
+
+    def _shutdown_if_idle(self, lease):
+        with lease.lock:
+            if lease.refs == 0 and lease.started:
+                self.shutdown(lease)
+                self.unreserve(lease.ip)
+            lease.timer = None
     
+    def _drop_lease(self, lease):
+        # called with lease.lock held
+        # the guest is kept warm for idle_window seconds, in case it is used again
+        # returns True if it is kept running, its ram must then stay reserved
+        lease.refs -= 1
+        if lease.refs == 0 and lease.started:
+            lease.timer = Timer(self.idle_window, self._shutdown_if_idle, [lease])
+            lease.timer.daemon = True
+            lease.timer.start()
+            return True
+        return False
+
     def release(self, ip=None):
-        # take the last digit of the ip
-        full_ip = ip
-        ip = ip.split(".")[-1]
+        lease = self.get_lease(ip)
+        with lease.lock:
+            warm = self._drop_lease(lease)
 
-        if self.to_release:
-            res = system_remote("qm shutdown " + ip, "127.0.0.1", "root")
-            print(res)
-            res = system_remote("pct shutdown " + ip, "127.0.0.1", "root")
-            print(res)
-        
-            while os.system("ping -c 1 " + full_ip) == 0:
-                time.sleep(10)
+        super().release(ip, warm)
 
-        super().release(ip)
+    def shutdown_idle(self):
+        # shut down now the idle guests started by us
+        with self.leases_mutex:
+            leases = list(self.leases.values())
+        for lease in leases:
+            with lease.lock:
+                if lease.timer is not None:
+                    lease.timer.cancel()
+                    lease.timer = None
+            self._shutdown_if_idle(lease)
 
 
 class MachineLock:
-    def __init__(self, machine, ip):
+    def __init__(self, machine, ip, cpus=1, ram=0, priority=0):
         self.machine = machine
         self.ip = ip
+        self.cpus = cpus
+        self.ram = ram
+        self.priority = priority
 
     def __enter__(self):
-        self.machine.use(self.ip)
+        self.machine.use(self.ip, self.cpus, self.ram, self.priority)
         return self
 
     def __exit__(self, type, value, traceback):
@@ -0,0 +1,89 @@
+import os
+import csv
+import json
+import time
+import contextlib
+from threading import Lock
+
+class RunMetrics:
+
+    def __init__(self):
+        self.start = time.time()
+        self.phases = []
+        self.counters = {}
+        self.mutex = Lock()
+
+    def __str__(self):
+        return "RunMetrics: " + time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.start))
+
+    def add(self, machine, name, value = 1):
+        with self.mutex:
+            key = (machine, name)
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def get(self, machine, name):
+        with self.mutex:
+            return self.counters.get((machine, name), 0)
+
+    @contextlib.contextmanager
+    def phase(self, machine, name):
+        # measures the wall time of the phase, and the bytes transferred by the machine meanwhile
+        record = {"machine": machine, "phase": name, "start": time.time(), "status": "failed"}
+        bytes_start = self.get(machine, "bytes")
+        try:
+            yield record
+            record["status"] = "ok"
+        finally:
+            record["duration"] = time.time() - record["start"]
+            record["bytes"] = self.get(machine, "bytes") - bytes_start
+            with self.mutex:
+                self.phases.append(record)
+
+    def to_dict(self):
+        with self.mutex:
+            return {
+                "start": self.start,
+                "duration": time.time() - self.start,
+                "phases": list(self.phases),
+                "counters": [{"machine": machine, "name": name, "value": value} for (machine, name), value in sorted(self.counters.items())],
+            }
+
+    def write(self, directory = "metrics"):
+        # writes <directory>/run-<date>.json, and the same numbers as machine,metric,value rows in run-<date>.csv
+        # returns the path of the json report
+        os.makedirs(directory, exist_ok=True)
+        base = os.path.join(directory, "run-" + time.strftime("%Y%m%d-%H%M%S", time.localtime(self.start)))
+        report = self.to_dict()
+        with open(base + ".json", "w") as f:
+            json.dump(report, f, indent=1)
+        with open(base + ".csv", "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["machine", "metric", "value"])
+            writer.writerow(["", "run_seconds", round(report["duration"], 3)])
+            for phase in report["phases"]:
+                writer.writerow([phase["machine"], "phase:" + phase["phase"] + ":seconds", round(phase["duration"], 3)])
+                writer.writerow([phase["machine"], "phase:" + phase["phase"] + ":bytes", phase["bytes"]])
+            for counter in report["counters"]:
+                writer.writerow([counter["machine"], counter["name"], counter["value"]])
+        return base + ".json"
+
+
+metrics = None
+metrics_mutex = Lock()
+
+def get_global_metrics():
+    global metrics_mutex
+    with metrics_mutex:
+        global metrics
+        if metrics is None:
+            metrics = RunMetrics()
+        return metrics
+
+def reset_global_metrics():
+    # starts a new run, returns the metrics of the previous one
+    global metrics_mutex
+    with metrics_mutex:
+        global metrics
+        previous = metrics
+        metrics = RunMetrics()
+        return previous
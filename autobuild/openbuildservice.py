@@ -1,9 +1,39 @@
 import os
-import contextlib
-from threading import Thread
+import time
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 import subprocess
 
-from autobuild.utils import launch_command, remember_cwd
+from autobuild.utils import launch_command
+
+# build states reported by osc results
+BUILD_STATES = ["succeeded", "failed", "unresolvable", "broken", "blocked", "dispatching", "scheduled", "building",
+                "signing", "finished", "disabled", "excluded", "locked", "deleting", "unknown"]
+# states that will not change anymore without a new commit
+FINAL_STATES = ["succeeded", "failed", "unresolvable", "broken", "disabled", "excluded", "locked"]
+FAILED_STATES = ["failed", "unresolvable", "broken"]
+
+def parse_results(text):
+    # returns {"repository/arch[/package]": state} from the output of osc results
+    table = {}
+    for line in text.splitlines():
+        fields = line.split()
+        if len(fields) < 3:
+            continue
+        state = None
+        for i in range(2, len(fields)):
+            field = fields[i].strip("()*:").lower()
+            if field in BUILD_STATES:
+                state = field
+                break
+        if state is None:
+            continue
+        table["/".join(fields[:i])] = state
+    return table
+
+def failed_results(table):
+    return sorted([target for target, state in table.items() if state in FAILED_STATES])
+
 
 class OpenBuildService:
 
@@ -18,71 +48,145 @@ class OpenBuildService:
         launch_command("osc co " + self.url + " -o " + self.dst)
 
     def up(self):
-        with remember_cwd():
-            os.chdir(self.dst)
-            launch_command("osc up")
+        launch_command("osc up", cwd=self.dst)
     
     def addall(self):
-        with remember_cwd():
-            os.chdir(self.dst)
-            launch_command("osc add *")
-            launch_command("osc add */*")
+        launch_command("osc add *", cwd=self.dst)
+        launch_command("osc add */*", cwd=self.dst)
     
     def add(self, filename):
-        with remember_cwd():
-            os.chdir(self.dst)
-            launch_command("osc add " + filename)
+        launch_command("osc add " + filename, cwd=self.dst)
 
     def update_src(self, src_tgz_path, dst_tgz_path, dst_dsc_path):
-        #os.chdir(self.dst)
         launch_command("cp " + src_tgz_path + " " + dst_tgz_path)
         self.update_dsc(dst_dsc_path, os.path.basename(dst_tgz_path))
 
     def commit(self):
-        with remember_cwd():
-            os.chdir(self.dst)
-            launch_command("osc ci -m \"Update to latest version (autobuild script by liza)\"")
+        launch_command("osc ci -m \"Update to latest version (autobuild script by liza)\"", cwd=self.dst)
     
     def get_status(self, logger = None):
-        with remember_cwd():
-            os.chdir(self.dst)
-            return launch_command("osc status", logger)
+        return launch_command("osc status", logger, cwd=self.dst)
 
     def get_binaries_list(self, logger = None):
-        with remember_cwd():
-            os.chdir(self.dst)
-            return launch_command("osc getbinaries help", logger)
+        return launch_command("osc getbinaries help", logger, cwd=self.dst)
+
+    def list_binaries(self, pkg, repository, arch):
+        # listing of the binaries built for repository/arch, with their sizes and dates
+        p = subprocess.run(["osc", "ls", "-b", "-l", "-r", repository, "-a", arch, self.url, pkg], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        if p.returncode != 0:
+            return None
+        return p.stdout.decode("utf-8")
+
+    def get_listing_path(self, pkg, repository, arch):
+        # kept out of the download directory, which only holds the artifacts
+        return os.path.join("state", "obs", pkg + "_" + repository + "_" + arch + ".listing")
 
-    def download_binaries(self, pkg, dest, logger = None):
-        # transform dest from relative (if relative) to absolute
+    def download_repository(self, pkg, repository, arch, dirname, retries = 3):
+        # download the binaries of repository/arch into dirname, unless the ones already there are up to date
+        result = {"repository": repository, "arch": arch, "directory": dirname, "status": "failed", "attempts": 0, "files": []}
+        listing = self.list_binaries(pkg, repository, arch)
+        listing_path = self.get_listing_path(pkg, repository, arch)
+        if listing is not None and os.path.isdir(dirname) and os.path.isfile(listing_path):
+            with open(listing_path, "r") as f:
+                if f.read() == listing:
+                    result["status"] = "unchanged"
+                    result["files"] = sorted(os.listdir(dirname))
+                    return result
+
+        if os.path.isfile(listing_path):
+            os.remove(listing_path)
+        for attempt in range(retries):
+            result["attempts"] = attempt + 1
+            shutil.rmtree(dirname, ignore_errors=True)
+            p = subprocess.run(["osc", "getbinaries", repository, arch, "-d", dirname], cwd=os.path.join(self.dst, pkg), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            result["output"] = p.stdout.decode("utf-8")
+            if p.returncode == 0:
+                break
+        else:
+            shutil.rmtree(dirname, ignore_errors=True)
+            return result
+
+        if not os.path.isdir(dirname) or len(os.listdir(dirname)) < 3:
+            shutil.rmtree(dirname, ignore_errors=True)
+            result["status"] = "empty"
+            return result
+        if listing is not None:
+            os.makedirs(os.path.dirname(listing_path), exist_ok=True)
+            with open(listing_path, "w") as f:
+                f.write(listing)
+        result["status"] = "downloaded"
+        result["files"] = sorted(os.listdir(dirname))
+        return result
+
+    def download_binaries(self, pkg, dest, logger = None, workers = 8):
+        # download the binaries of every repository/arch of pkg into dest/<repository>_<arch>, a few at a time
+        # returns {"<repository>_<arch>": result}, see download_repository
         dest = os.path.abspath(dest)
+        os.makedirs(dest, exist_ok=True)
+        # listings written into dest by older versions
+        for filename in os.listdir(dest):
+            if filename.endswith(".listing"):
+                os.remove(os.path.join(dest, filename))
         binaries_list = self.get_binaries_list(logger)
+        targets = []
         for line in binaries_list.splitlines():
             if "Invalid" in line:
                 continue
-            try:
-                for i in range(5):
-                    line = line.replace("  ", " ")
-                dirname = os.path.join(dest, line.replace(" ", "_"))
-                print(f"Downloading binaries for {line} into {dirname}")
-                with remember_cwd():
-                    os.chdir(self.dst)
-                    os.chdir(pkg)
-                    # launch_command(f"osc getbinaries {line} -d {dirname}", logger)
-                    print(f"osc getbinaries {line} -d {dirname}")
-                    os.system(f"osc getbinaries {line} -d {dirname}")
-                    if len(os.listdir(dirname)) < 3:
-                        launch_command(f"rm -rf {dirname}", logger)
-            except Exception as e:
-                print(f"Error: {e}")
+            fields = line.split()
+            if len(fields) != 2:
                 continue
+            targets.append((fields[0], fields[1]))
+
+        results = {}
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {}
+            for repository, arch in targets:
+                name = repository + "_" + arch
+                print(f"Downloading binaries for {repository} {arch} into {os.path.join(dest, name)}")
+                futures[name] = executor.submit(self.download_repository, pkg, repository, arch, os.path.join(dest, name))
+            for name, future in futures.items():
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    results[name] = {"repository": name, "status": "failed", "error": str(e)}
+                print(f"{name}: {results[name]['status']}")
+        return results
     
     def get_results(self, logger = None):
-        with remember_cwd():
-            os.chdir(self.dst)
-            return launch_command("osc results", logger)
+        return launch_command("osc results", logger, cwd=self.dst)
     
+    def get_results_table(self, logger = None):
+        return parse_results(self.get_results(logger))
+
     def is_building(self):
-        results = self.get_results()
-        return "(building)" in results or "(finished)" in results or "(dispatching)" in results
+        table = self.get_results_table()
+        return any([state not in FINAL_STATES for state in table.values()])
+
+    def wait_for_results(self, logger = None, min_wait = 120, initial_delay = 10, max_delay = 60, timeout = 12 * 3600):
+        # wait until every repository reached a final state, and return the table of states
+        # right after a commit, OBS can still report the results of the previous build,
+        # so final states are trusted once a pending state was seen or after min_wait seconds
+        # the delay between two polls grows while nothing changes and is reset when a state changes,
+        # up to max_delay, the interval of the fixed polling it replaces, so that a final state is never noticed later than before
+        start = time.time()
+        delay = initial_delay
+        seen_pending = False
+        previous = None
+        while True:
+            table = self.get_results_table(logger)
+            pending = [target for target, state in table.items() if state not in FINAL_STATES]
+            if len(pending) > 0:
+                seen_pending = True
+            elif len(table) > 0 and (seen_pending or time.time() - start >= min_wait):
+                return table
+            if time.time() - start > timeout:
+                print("Timeout while waiting for " + self.url + ", still pending: " + ", ".join(pending))
+                return table
+            if table != previous:
+                delay = initial_delay
+            else:
+                delay = min(delay * 1.5, max_delay)
+            previous = table
+            print("Waiting " + str(round(delay)) + " seconds for " + str(len(pending)) + " builds of " + self.url)
+            time.sleep(delay)
 
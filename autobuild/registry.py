@@ -0,0 +1,91 @@
+import os
+import json
+import time
+from threading import Lock
+
+from autobuild.sync import file_sha1
+
+def list_files(path):
+    if os.path.isfile(path):
+        return [path]
+    files = []
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            files.append(os.path.join(dirpath, filename))
+    return sorted(files)
+
+
+class ArtifactRegistry:
+
+    def __init__(self, path = "distr/registry.json"):
+        self.path = path
+        self.entries = {}
+        self.mutex = Lock()
+        self.load()
+
+    def __str__(self):
+        return "ArtifactRegistry: " + self.path
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path, "r") as f:
+                self.entries = json.load(f)
+        except ValueError:
+            self.entries = {}
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        os.replace(self.path + ".tmp", self.path)
+
+    def record(self, name, inputs, paths):
+        # remember that the files of paths are the artifacts of name for inputs
+        artifacts = {}
+        for path in paths:
+            for filename in list_files(path):
+                stat = os.stat(filename)
+                artifacts[filename] = [stat.st_size, stat.st_mtime_ns, file_sha1(filename)]
+        with self.mutex:
+            self.entries[name] = {"inputs": inputs, "artifacts": artifacts, "time": time.time()}
+            self.save()
+
+    def forget(self, name):
+        with self.mutex:
+            if name in self.entries:
+                del self.entries[name]
+                self.save()
+
+    def is_built(self, name, inputs):
+        # True if the artifacts of name for inputs are recorded and still on disk, unchanged
+        # the files are only hashed again when their size or mtime changed
+        with self.mutex:
+            entry = self.entries.get(name)
+        if entry is None or entry["inputs"] != inputs or len(entry["artifacts"]) == 0:
+            return False
+        for filename, artifact in entry["artifacts"].items():
+            # [size, sha1] in the registries written before the mtime was recorded
+            size, sha1 = artifact[0], artifact[-1]
+            mtime = artifact[1] if len(artifact) == 3 else None
+            if not os.path.isfile(filename):
+                return False
+            stat = os.stat(filename)
+            if stat.st_size != size:
+                return False
+            if stat.st_mtime_ns != mtime and file_sha1(filename) != sha1:
+                return False
+        return True
+
+
+artifact_registry = None
+artifact_registry_mutex = Lock()
+
+def get_global_artifact_registry():
+    global artifact_registry_mutex
+    with artifact_registry_mutex:
+        global artifact_registry
+        if artifact_registry is None:
+            artifact_registry = ArtifactRegistry()
+        return artifact_registry
@@ -0,0 +1,59 @@
+import time
+import collections
+
+# the marker printed after each step of a script, followed by the index and the exit status of the step
+# it is quoted in the command so that the echo of the script by the terminal does not contain it
+STEP_MARKER = "+++STEP+++"
+STEP_MARKER_COMMAND = "echo '+++'STEP+++"
+
+def make_script(commands, stop_on_error = True):
+    # returns the lines of a shell script running commands, each followed by its marker
+    # each command runs in the shell of the script (so that cd, export and source last), with stdin closed
+    # so that it can not read the next lines of the script
+    # with stop_on_error, the commands following a failing one are skipped, as with set -e
+    # the script runs in a subshell: cd and export carry over between its steps, but not to the pooled shell
+    # used by the next scripts
+    lines = ["(", "autobuild_status=0"]
+    for i in range(len(commands)):
+        marker = STEP_MARKER_COMMAND + " " + str(i)
+        if stop_on_error:
+            lines.append("if [ \"$autobuild_status\" = 0 ]; then {")
+            lines.append(commands[i])
+            lines.append("} < /dev/null; autobuild_status=$?; " + marker + " $autobuild_status; else " + marker + " skipped; fi")
+        else:
+            lines.append("{")
+            lines.append(commands[i])
+            lines.append("} < /dev/null; " + marker + " $?")
+    lines.append(")")
+    return lines
+
+
+class ScriptOutput:
+    # splits the output lines of a script made by make_script into the steps it ran
+    # without keep_output, only the last tail lines of each step are kept
+
+    def __init__(self, commands, keep_output = True, tail = 50):
+        self.commands = commands
+        self.size = None if keep_output else tail
+        self.results = []
+        self.output = collections.deque(maxlen=self.size)
+        self.step_start = time.time()
+
+    def add(self, line):
+        if STEP_MARKER in line:
+            fields = line[line.find(STEP_MARKER) + len(STEP_MARKER):].split()
+            if len(fields) >= 2 and fields[0].isdigit() and int(fields[0]) == len(self.results) and len(self.results) < len(self.commands):
+                exit_code = int(fields[1]) if fields[1].lstrip("-").isdigit() else None
+                self.results.append((self.commands[len(self.results)], "\n".join(self.output), exit_code, time.time() - self.step_start))
+                self.output = collections.deque(maxlen=self.size)
+                self.step_start = time.time()
+                return
+        self.output.append(line)
+
+    def finish(self):
+        # returns a list of (command, output, exit code, duration), the exit code is None for a skipped step,
+        # and for the steps whose marker never came, if the shell died on the way
+        while len(self.results) < len(self.commands):
+            self.results.append((self.commands[len(self.results)], "\n".join(self.output), None, 0))
+            self.output = collections.deque(maxlen=self.size)
+        return self.results
@@ -0,0 +1,147 @@
+import os
+import json
+import heapq
+from concurrent.futures import Future
+from queue import Queue
+from threading import Thread, Lock
+
+class Job:
+
+    def __init__(self, function, name=""):
+        self.function = function
+        self.name = name
+        self.future = Future()
+
+    def __str__(self):
+        return "Job: " + self.name
+
+
+class Scheduler:
+
+    def __init__(self, num_workers=16):
+        self.queue = Queue()
+        self.workers = []
+        for i in range(num_workers):
+            worker = Thread(target=self._worker_main, name="autobuild-worker-" + str(i), daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def _worker_main(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            if not job.future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = job.function()
+            except BaseException as e:
+                job.future.set_exception(e)
+            else:
+                job.future.set_result(result)
+
+    def _enqueue_after(self, job, after, propagate_failure):
+        # with propagate_failure, a job whose dependency failed fails the same way, without running
+        if not propagate_failure:
+            self.queue.put(job)
+        elif after.cancelled():
+            job.future.cancel()
+        elif after.exception() is not None:
+            if job.future.set_running_or_notify_cancel():
+                job.future.set_exception(after.exception())
+        else:
+            self.queue.put(job)
+
+    def submit(self, function, name="", after=None, callback=None, propagate_failure=True):
+        # after is an optional future that must complete before the job starts
+        job = Job(function, name)
+        if callback is not None:
+            job.future.add_done_callback(callback)
+        if after is None:
+            self.queue.put(job)
+        else:
+            after.add_done_callback(lambda f: self._enqueue_after(job, f, propagate_failure))
+        return job.future
+
+    def shutdown(self):
+        for worker in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+
+class DurationHistory:
+
+    def __init__(self, path = "state/durations.json", default = 600, keep = 5):
+        # default: estimated duration, in seconds, of a phase never run before
+        # keep: number of past durations averaged for the estimation
+        self.path = path
+        self.default = default
+        self.keep = keep
+        self.durations = {}
+        self.mutex = Lock()
+        if os.path.isfile(self.path):
+            try:
+                with open(self.path, "r") as f:
+                    self.durations = json.load(f)
+            except ValueError:
+                self.durations = {}
+
+    def record(self, name, phase, duration):
+        with self.mutex:
+            durations = self.durations.setdefault(name, {}).setdefault(phase, [])
+            durations.append(duration)
+            del durations[:-self.keep]
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path + ".tmp", "w") as f:
+                json.dump(self.durations, f, indent=1)
+            os.replace(self.path + ".tmp", self.path)
+
+    def estimate(self, name, phase):
+        with self.mutex:
+            durations = self.durations.get(name, {}).get(phase, [])
+            if len(durations) == 0:
+                return self.default
+            return sum(durations) / len(durations)
+
+
+def estimate_makespan(jobs, capacity):
+    # jobs: list of (duration, cpus) run on a host with capacity cpus, longest first, each as soon as enough cpus are free
+    # returns the time at which the last job ends
+    running = []
+    now = 0
+    free = capacity
+    end = 0
+    for duration, cpus in sorted(jobs, reverse=True):
+        cpus = min(cpus, capacity)
+        while free < cpus:
+            now, released = heapq.heappop(running)
+            free += released
+        heapq.heappush(running, (now + duration, cpus))
+        free -= cpus
+        end = max(end, now + duration)
+    return end
+
+
+scheduler = None
+scheduler_mutex = Lock()
+
+def get_global_scheduler():
+    global scheduler_mutex
+    with scheduler_mutex:
+        global scheduler
+        if scheduler is None:
+            scheduler = Scheduler()
+        return scheduler
+
+duration_history = None
+duration_history_mutex = Lock()
+
+def get_global_duration_history():
+    global duration_history_mutex
+    with duration_history_mutex:
+        global duration_history
+        if duration_history is None:
+            duration_history = DurationHistory()
+        return duration_history
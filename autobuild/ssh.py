@@ -1,22 +1,156 @@
 from abc import ABC, abstractmethod
 import os
 import time
-from threading import Thread
+import codecs
+import select
+from threading import Thread, Lock
 import logging
 import paramiko
 import re
+import shlex
+
+from autobuild.sync import SyncManifest, scan_tree, diff_trees, files_digest
+from autobuild.metrics import get_global_metrics
+from autobuild.logs import LineBatcher
+from autobuild.remotescript import make_script, ScriptOutput
+
+ANSI_ESCAPE = re.compile(r'\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])')
+
+# the sentinel printed after each command, followed by the exit status of the command
+SENTINEL = "+++END+++"
+SENTINEL_COMMAND = "echo +++END+++ $?"
+
+# file of the remote tree holding the digest of the files of the last push
+SYNC_MARKER = ".autobuild-sync"
+
+class SSHCommandError(Exception):
+
+    def __init__(self, ip, command, exit_code, output):
+        super().__init__("Command " + command + " failed on " + ip + " with exit code " + str(exit_code))
+        self.ip = ip
+        self.command = command
+        self.exit_code = exit_code
+        self.output = output
+
+# sets of disabled algorithms to try, in order, when connecting to a new host
+SSH_ALGORITHMS = [
+    {'pubkeys': ['rsa-sha2-256', 'rsa-sha2-512']},
+    {'pubkeys': []},
+]
+
+class SSHConnectionPool:
+
+    def __init__(self, keepalive=30):
+        self.keepalive = keepalive
+        self.clients = {}
+        self.shells = {}
+        self.algorithms = {}
+        self.locks = {}
+        self.mutex = Lock()
+
+    def get_lock(self, ip, username):
+        with self.mutex:
+            key = (ip, username)
+            if key not in self.locks:
+                self.locks[key] = Lock()
+            return self.locks[key]
+
+    def is_alive(self, client):
+        transport = client.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        try:
+            transport.send_ignore()
+        except Exception:
+            return False
+        return True
+
+    def is_shell_alive(self, channel):
+        if channel.closed or channel.exit_status_ready():
+            return False
+        transport = channel.get_transport()
+        return transport is not None and transport.is_active()
+
+    def connect(self, ip, username, log = None):
+        # try the algorithms that worked last time for this host first
+        algorithms = SSH_ALGORITHMS
+        if ip in self.algorithms:
+            algorithms = [self.algorithms[ip]] + [a for a in SSH_ALGORITHMS if a != self.algorithms[ip]]
+        error = None
+        for disabled_algorithms in algorithms:
+            try:
+                client = paramiko.SSHClient()
+                client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+                client.connect(ip, username=username, disabled_algorithms=disabled_algorithms)
+            except Exception as e:
+                if log is not None:
+                    log(ip, "Failed to connect to " + ip + " with disabled algorithms " + str(disabled_algorithms) + ": " + str(e))
+                error = e
+                continue
+            self.algorithms[ip] = disabled_algorithms
+            client.get_transport().set_keepalive(self.keepalive)
+            return client
+        raise error
+
+    def get_client(self, ip, username, log = None):
+        with self.get_lock(ip, username):
+            key = (ip, username)
+            client = self.clients.get(key)
+            if client is not None and self.is_alive(client):
+                return client
+            if client is not None:
+                client.close()
+            client = self.connect(ip, username, log)
+            self.clients[key] = client
+            return client
+
+    def get_shell(self, ip, username, shell):
+        # returns the interactive shell left by a previous phase, if still usable
+        with self.mutex:
+            key = (ip, username, shell)
+            channel = self.shells.get(key)
+            if channel is not None and not self.is_shell_alive(channel):
+                del self.shells[key]
+                channel = None
+            return channel
+
+    def put_shell(self, ip, username, shell, channel):
+        with self.mutex:
+            self.shells[(ip, username, shell)] = channel
+
+    def close(self):
+        with self.mutex:
+            for channel in self.shells.values():
+                channel.close()
+            for client in self.clients.values():
+                client.close()
+            self.shells = {}
+            self.clients = {}
+
+
+ssh_pool = None
+ssh_pool_mutex = Lock()
+
+def get_global_ssh_pool():
+    global ssh_pool_mutex
+    with ssh_pool_mutex:
+        global ssh_pool
+        if ssh_pool is None:
+            ssh_pool = SSHConnectionPool()
+        return ssh_pool
+
 
 class SSHHelper(ABC):
         
         def __init__(self, ip, username):
             self.ip = ip
             self.username = username
+            self.name = ip
             self.default_shell = ""
             self.default_rsync = ""
 
-            self.lines = []
-            self.current_line = ""
             self.skip_empty_lines = False
+            self.channel_buffer = ""
         
         def log_error(self, prefix, message):
             print("ERROR: " + prefix + " - " + message)
@@ -33,11 +167,25 @@ class SSHHelper(ABC):
         def set_default_rsync(self, rsync):
             self.default_rsync = rsync
         
-        def rsync(self, src, dst):
+        def rsync(self, src, dst, options = ""):
             rsync_path_arg = ""
             if self.default_rsync != "":
                 rsync_path_arg = "--rsync-path=" + self.default_rsync
-            self.system("rsync -avz " + rsync_path_arg + " " + src + " " + dst)
+            # exit code 24 is for source files that vanished during the transfer
+            # the list of the files can be huge, only the last lines, with the statistics, are kept
+            result = self.run_system("rsync -avz --stats " + options + " " + rsync_path_arg + " " + src + " " + dst, False).check([0, 24])
+            # account for the bytes transferred, from the statistics printed by rsync
+            transferred = 0
+            for line in result.tail:
+                if line.startswith("Total bytes sent:") or line.startswith("Total bytes received:"):
+                    # the digits are grouped with the separator of the locale (1,234,567 or 1.234.567)
+                    digits = re.sub(r"\D", "", line.split(":")[1])
+                    if digits != "":
+                        transferred += int(digits)
+            metrics = get_global_metrics()
+            metrics.add(self.name, "rsync_bytes", transferred)
+            metrics.add(self.name, "bytes", transferred)
+            return "\n".join(result.tail)
         
         def copy_host_to_remote(self, src, dst):
             self.log_debug(self.ip, "Copying pulsar:" + src + " to " + self.ip + ":" + dst)
@@ -48,10 +196,56 @@ class SSHHelper(ABC):
             self.log_debug(self.ip, "Copying " + self.ip + ":" + src + " to pulsar:" + dst)
             self.rsync(self.username + "@" + self.ip + ":" + src, dst)
 
+        def sync_host_to_remote(self, src, dst, manifest_path, force = False):
+            # push only the files of src that changed since the last push recorded in manifest_path,
+            # keeping the remote tree so that it can be rebuilt incrementally
+            # returns True if the whole tree has been pushed again
+            manifest = SyncManifest(manifest_path)
+            known = manifest.load() and manifest.remote == self.username + "@" + self.ip + ":" + dst
+            if known and not force:
+                # the remote tree may have been removed, restored from a snapshot or edited meanwhile,
+                # it is trusted only if it still holds the marker of the last push
+                text = self.launch_ssh_command("cat " + dst + "/" + SYNC_MARKER)
+                if files_digest(manifest.files) not in text:
+                    self.log_debug(self.ip, "Remote tree " + dst + " does not match the last push")
+                    known = False
+            files = scan_tree(src, manifest.files if known else None)
+
+            # if the push is interrupted, the next one will be a full one
+            manifest.invalidate()
+            if force or not known:
+                self.log_debug(self.ip, "Full sync of " + src + " to " + self.ip + ":" + dst)
+                self.launch_ssh_command("rm -rf " + dst)
+                self.copy_host_to_remote(src + "/*", dst)
+            else:
+                changed, deleted = diff_trees(manifest.files, files)
+                self.log_debug(self.ip, "Incremental sync of " + src + " to " + self.ip + ":" + dst + ": " + str(len(changed)) + " changed, " + str(len(deleted)) + " deleted")
+                if len(deleted) > 0:
+                    # the removals are pushed as a script, sent through the terminal they could exceed its line limit
+                    with open(manifest_path + ".deleted.sh", "w") as f:
+                        for i in range(0, len(deleted), 100):
+                            f.write("rm -f " + " ".join([shlex.quote(path) for path in deleted[i:i + 100]]) + "\n")
+                    self.rsync(manifest_path + ".deleted.sh", self.username + "@" + self.ip + ":" + dst + ".deleted.sh")
+                    os.remove(manifest_path + ".deleted.sh")
+                    # the paths are relative to dst, nothing must be removed if it can not be entered
+                    self.launch_ssh_commands(["cd " + dst + " && sh " + dst + ".deleted.sh", "rm -f " + dst + ".deleted.sh"], check=True)
+                if len(changed) > 0:
+                    with open(manifest_path + ".files", "w") as f:
+                        f.write("\n".join(changed) + "\n")
+                    self.log_debug(self.ip, "Copying pulsar:" + src + " to " + self.ip + ":" + dst)
+                    self.rsync(src + "/", self.username + "@" + self.ip + ":" + dst + "/", "--files-from=" + manifest_path + ".files")
+                    os.remove(manifest_path + ".files")
+
+            self.launch_ssh_commands(["echo " + files_digest(files) + " > " + dst + "/" + SYNC_MARKER], check=True)
+            manifest.remote = self.username + "@" + self.ip + ":" + dst
+            manifest.files = files
+            manifest.save()
+            return force or not known
+
         def set_default_shell(self, shell):
             self.default_shell = shell
         
-        def display_channel_text(self, line):
+        def display_channel_text(self, line, batcher = None):
             if line.endswith("\r"):
                 return
             if line == "":
@@ -60,80 +254,170 @@ class SSHHelper(ABC):
                 self.skip_empty_lines = True
             else:
                 self.skip_empty_lines = False
-            self.log_debug(self.ip, line)
+            if batcher is not None:
+                batcher.add(line)
+            else:
+                self.log_debug(self.ip, line)
 
-        def process_channel_text(self, line):
-            self.current_line += line
-            if "\n" in line:
-                self.current_line_split = self.current_line.split("\n")
-                for i in range(len(self.current_line_split) - 1):
-                    self.lines.append(self.current_line_split[i])
-                    self.display_channel_text(self.current_line_split[i])
-                self.current_line = self.current_line_split[-1]
+        def clean_channel_line(self, line, commandend = None):
+            if line.endswith("\r"):
+                line = line[:-1]
+            line = ANSI_ESCAPE.sub('', line)
+            if commandend is not None:
+                line = line.replace(commandend, "---END---")
+            return line
 
-        def read_channel_until(self, end = None, commandend = None, timeout = None):
-            self.lines = []
-            self.current_line = ""
-            ansi_escape = re.compile(r'\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])')
-            start = time.time()
+        def iter_channel_lines(self, end = None, commandend = None, timeout = None):
+            # yield the lines of the channel as they arrive, until a line contains end,
+            # or until nothing has been received for timeout seconds
+            decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+            pending = self.channel_buffer
+            self.channel_buffer = ""
+            last = time.time()
             while True:
-                if not self.channel.recv_ready():
-                    if timeout is not None:
-                        if time.time() - start > timeout:
-                            break
-                    time.sleep(1)
-                    continue
-                start = time.time()
-                line = self.channel.recv(1024)
-                line = line.decode("utf-8")
-                line = line.replace("\r\n", "\n")
-                line = ansi_escape.sub('', line)
-                    
-                if commandend is not None:
-                    line = line.replace(commandend, "---END---")
-                self.process_channel_text(line)
-                if end is not None:
-                    if end in line:
+                if "\n" not in pending:
+                    if not self.channel.recv_ready():
+                        wait = 1
+                        if timeout is not None:
+                            wait = timeout - (time.time() - last)
+                            if wait <= 0:
+                                break
+                        readable, _, _ = select.select([self.channel], [], [], wait)
+                        if len(readable) == 0:
+                            continue
+                    data = self.channel.recv(65536)
+                    if len(data) == 0:
+                        # channel closed
                         break
-            
-            self.display_channel_text(self.current_line)
-            text = "\n".join(self.lines)
-            return text
+                    last = time.time()
+                    pending += decoder.decode(data)
+                    if "\n" not in pending:
+                        continue
+                lines = pending.split("\n")
+                pending = lines.pop()
+                for i in range(len(lines)):
+                    line = self.clean_channel_line(lines[i], commandend)
+                    yield line
+                    if end is not None and end in line:
+                        # keep what follows the end for the next read
+                        self.channel_buffer = "\n".join(lines[i + 1:] + [pending])
+                        return
 
-        def launch_ssh_command(self, command, reset_connection = True):
-            if reset_connection:
-                self.log_debug(self.ip, "Connecting to " + self.ip)
-                try:
-                    self.ssh = paramiko.SSHClient()
-                    self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                    self.ssh.connect(self.ip, username=self.username, disabled_algorithms={'pubkeys': ['rsa-sha2-256', 'rsa-sha2-512']})
-                except Exception as e:
-                    self.log_error(self.ip, "Failed to connect to " + self.ip + " with default algorithms, retrying with no disabled algorithms")
-                    self.ssh = paramiko.SSHClient()
-                    self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                    self.ssh.connect(self.ip, username=self.username, disabled_algorithms={'pubkeys': []})
-                self.log_debug(self.ip, "Connected to " + self.ip + "\n\n\n")
-
-                self.channel = self.ssh.invoke_shell()
-                self.read_channel_until(timeout = 10)
+            pending += decoder.decode(b"", final=True)
+            if pending != "":
+                yield self.clean_channel_line(pending, commandend)
+
+        def read_channel_until(self, end = None, commandend = None, timeout = None):
+            lines = []
+            batcher = LineBatcher(lambda text: self.log_debug(self.ip, text))
+            for line in self.iter_channel_lines(end, commandend, timeout):
+                self.display_channel_text(line, batcher)
+                lines.append(line)
+            batcher.flush()
+            return "\n".join(lines)
+
+        def open_ssh_shell(self):
+            pool = get_global_ssh_pool()
+            channel = pool.get_shell(self.ip, self.username, self.default_shell)
+            if channel is not None:
+                # reuse the shell of the previous phase, starting back from the home directory
+                self.log_debug(self.ip, "Reusing connection to " + self.ip)
+                self.channel = channel
+                self.channel.send("cd ~\r\n")
                 self.channel.send("echo '+++END+++'\r\n")
                 self.read_channel_until("+++END+++", "echo '+++END+++'")
+                return
 
-                if self.default_shell != "":
-                    self.log_debug(self.ip, "Launching default shell " + self.default_shell)
-                    self.channel.send(self.default_shell.replace("\\", "\\\\") + "\n")
-                    self.channel.send("echo '+++END+++'\r\n")
-                    self.read_channel_until("+++END+++", "echo '+++END+++'")
+            self.log_debug(self.ip, "Connecting to " + self.ip)
+            start = time.time()
+            self.ssh = pool.get_client(self.ip, self.username, self.log_error)
+            get_global_metrics().add(self.name, "ssh_connect_seconds", time.time() - start)
+            get_global_metrics().add(self.name, "ssh_connects")
+            self.log_debug(self.ip, "Connected to " + self.ip + "\n\n\n")
 
-            self.log_debug(self.ip, "Launching command " + command)
-            self.channel.send(command.replace("\\", "\\\\") + "\r\n")
+            # the sentinel comes after the banner, no need to wait for the banner to end
+            self.channel = self.ssh.invoke_shell()
             self.channel.send("echo '+++END+++'\r\n")
-            text = self.read_channel_until("+++END+++", "echo '+++END+++'")
+            self.read_channel_until("+++END+++", "echo '+++END+++'")
+
+            if self.default_shell != "":
+                self.log_debug(self.ip, "Launching default shell " + self.default_shell)
+                self.channel.send(self.default_shell.replace("\\", "\\\\") + "\n")
+                self.channel.send("echo '+++END+++'\r\n")
+                self.read_channel_until("+++END+++", "echo '+++END+++'")
 
-            self.log_debug(self.ip, "Done launching command " + command + "\n\n\n")
-            return text
+            pool.put_shell(self.ip, self.username, self.default_shell, self.channel)
 
-                
+        def parse_exit_code(self, line):
+            # the shell before the default one (cmd.exe on Windows) does not expand $?
+            status = line[line.find(SENTINEL) + len(SENTINEL):].strip().strip("'\"")
+            try:
+                return int(status)
+            except ValueError:
+                return None
+
+        def run_ssh_command(self, command, reset_connection = True):
+            # returns the output of the command, its exit code (None if unknown) and its duration
+            if reset_connection:
+                self.open_ssh_shell()
+
+            self.log_debug(self.ip, "Launching command " + command)
+            start = time.time()
+            self.channel.sendall(command.replace("\\", "\\\\") + "\r\n")
+            self.channel.sendall(SENTINEL_COMMAND + "\r\n")
+            lines = []
+            exit_code = None
+            batcher = LineBatcher(lambda text: self.log_debug(self.ip, text))
+            for line in self.iter_channel_lines(SENTINEL, SENTINEL_COMMAND):
+                self.display_channel_text(line, batcher)
+                if SENTINEL in line:
+                    exit_code = self.parse_exit_code(line)
+                elif "---END---" not in line:
+                    lines.append(line)
+            batcher.flush()
+            duration = time.time() - start
+
+            self.log_debug(self.ip, "Done launching command " + command + " (exit code " + str(exit_code) + ", " + str(round(duration, 1)) + "s)\n\n\n")
+            return "\n".join(lines), exit_code, duration
+
+        def launch_ssh_command(self, command, reset_connection = True):
+            return self.run_ssh_command(command, reset_connection)[0]
         
-        def launch_ssh_commands(self, commands):
-            return "\n".join([self.launch_ssh_command(commands[i], i == 0) for i in range(len(commands))])
\ No newline at end of file
+        def run_ssh_script(self, commands, stop_on_error = True, reset_connection = True, keep_output = True, tail = 50):
+            # sends all the commands in a single round trip, and parses the output of every step from the channel
+            # with stop_on_error, the commands following a failing one are skipped, as with set -e
+            # without keep_output, only the last tail lines of each step are kept in memory
+            # returns a list of (command, output, exit code, duration), the exit code is None for a skipped step
+            if reset_connection:
+                self.open_ssh_shell()
+
+            self.log_debug(self.ip, "Launching script of " + str(len(commands)) + " commands")
+            lines = make_script(commands, stop_on_error) + [SENTINEL_COMMAND]
+            start = time.time()
+            # send only writes what fits in a packet
+            self.channel.sendall("\r\n".join(lines).replace("\\", "\\\\") + "\r\n")
+            script_output = ScriptOutput(commands, keep_output, tail)
+            batcher = LineBatcher(lambda text: self.log_debug(self.ip, text))
+            for line in self.iter_channel_lines(SENTINEL, SENTINEL_COMMAND):
+                self.display_channel_text(line, batcher)
+                if SENTINEL not in line and "---END---" not in line:
+                    script_output.add(line)
+            batcher.flush()
+            results = script_output.finish()
+
+            for command, text, exit_code, duration in results:
+                self.log_debug(self.ip, "Step " + command + " (exit code " + str(exit_code) + ", " + str(round(duration, 1)) + "s)")
+            self.log_debug(self.ip, "Done launching script (" + str(round(time.time() - start, 1)) + "s)\n\n\n")
+            return results
+
+        def launch_ssh_commands(self, commands, check = False, keep_output = True):
+            # the commands are sent as a single script
+            # with check, stop at the first command exiting with a non zero status
+            # without keep_output, only the last lines of each command are returned
+            results = self.run_ssh_script(commands, check, keep_output=keep_output)
+            texts = [text for command, text, exit_code, duration in results]
+            for command, text, exit_code, duration in results:
+                if check and exit_code is not None and exit_code != 0:
+                    self.log_error(self.ip, "Command " + command + " failed with exit code " + str(exit_code))
+                    raise SSHCommandError(self.ip, command, exit_code, "\n".join(texts))
+            return "\n".join(texts)
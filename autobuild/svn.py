@@ -1,61 +1,161 @@
 import os
+import shutil
+import datetime
 from threading import Thread, Lock
 
-from autobuild.utils import launch_command, remember_cwd
+from autobuild.utils import run_command, CommandError, link_tree, copy_over, write_tarball, DEFAULT_TARBALL_MTIME
+
+# copy: full copy of the tree
+# reflink: copy on write copy of the tree, on file systems supporting it (a full copy otherwise)
+# hardlink: tree of hard links to the files of the checkout, without the .svn metadata,
+#           files overwritten by a patch are replaced, never modified in place
+DUPLICATE_MODES = ["copy", "reflink", "hardlink"]
 
 class SVN:
 
-    def __init__(self, url, dst):
+    def __init__(self, url, dst, excludes = []):
+        # excludes: directories of the repository that no target needs, left out of the working copy
         self.url = url
         self.dst = dst
+        self.excludes = excludes
         self.has_been_updated = False
         self.revision = ""
+        # paths (relative to dst) changed by the last update
+        self.changed_paths = []
         self.mutex = Lock()
 
     def __str__(self):
         with self.mutex:
             return "SVN: " + self.url + " -> " + self.dst
 
+    def info(self, item, target = None):
+        # one item of svn info (revision, url, last-changed-revision, ...), empty if it fails
+        result = run_command(["svn", "info", "--show-item", item, self.dst if target is None else target])
+        return result.output.strip() if result.returncode == 0 else ""
+
+    def is_working_copy(self):
+        # True if dst is a checkout of url that can be updated
+        if not os.path.isdir(os.path.join(self.dst, ".svn")):
+            return False
+        return self.info("url").rstrip("/") == self.url.rstrip("/")
+
+    def set_sparse_excludes(self):
+        for path in self.excludes:
+            if os.path.exists(os.path.join(self.dst, path)):
+                run_command(["svn", "update", "--set-depth", "exclude", path], cwd=self.dst, keep_output=False).check()
+
     def co(self):
         with self.mutex:
-            launch_command("svn co " + self.url + " " + self.dst)
+            run_command(["svn", "co", self.url, self.dst], keep_output=False).check()
+            self.set_sparse_excludes()
+            self.revision = self.info("revision")
+            self.changed_paths = []
+
+    def co_or_up(self):
+        # reuse the working copy left by a previous run when there is one, a fresh checkout takes minutes
+        if self.is_working_copy():
+            run_command(["svn", "cleanup"], cwd=self.dst, keep_output=False)
+            with self.mutex:
+                self.revision = self.info("revision")
+                self.set_sparse_excludes()
+            try:
+                self.up()
+                return
+            except CommandError as e:
+                print("Failed to update " + self.dst + ", checking out again: " + str(e))
+        shutil.rmtree(self.dst, ignore_errors=True)
+        self.co()
+
+    def remote_revision(self):
+        # last revision changing the repository at url, without touching the working copy
+        # empty if the server is unreachable
+        return self.info("last-changed-revision", self.url)
+
+    def last_changed_revision(self):
+        return self.info("last-changed-revision")
+
+    def get_changed_paths(self, start, end):
+        # paths of the working copy changed by the revisions start to end, from svn log
+        # None if they are unknown, then everything should be considered as changed
+        result = run_command(["svn", "log", "-q", "-v", "-r", str(start) + ":" + str(end), self.dst])
+        if result.returncode != 0:
+            return None
+        # the paths of svn log are relative to the root of the repository
+        prefix = self.info("relative-url").lstrip("^") + "/"
+        paths = set()
+        for line in result.output.splitlines():
+            line = line.strip()
+            # "M /trunk/src/configure.in", "A /trunk/src/foo (from /trunk/src/bar:123)"
+            if len(line) < 3 or line[0] not in "AMDR" or line[1] != " ":
+                continue
+            path = line[2:].split(" (from ")[0]
+            if path.startswith(prefix):
+                paths.add(path[len(prefix):])
+        return sorted(paths)
 
     def up(self):
         with self.mutex:
-            with remember_cwd():
-                os.chdir(self.dst)
-                cmd = launch_command("svn up")
-                if "At revision" in cmd:
-                    index = cmd.find("At revision")
-                    index2 = cmd.find(".", index)
-                    new_revision = cmd[index+12:index2]
-                    if new_revision != self.revision:
-                        print("Old revision: " + self.revision)
-                        print("New revision: " + new_revision)
-                        self.has_been_updated = self.revision != ""
-                        self.revision = new_revision
-                    else:
-                        self.has_been_updated = False
-                else:
-                    self.has_been_updated = False
-
-    def make_tgz(self, name):
-        with self.mutex:
-            # we want to create a tar.gz named name.tar.gz with a folder inside named name containing the content of self.dst in the current directory
-            if os.path.isdir(name):
-                launch_command("rm -rf " + name)
-            os.rename(self.dst, name)
-            launch_command("tar -czf " + name + ".tar.gz " + name)
-            os.rename(name, self.dst)
+            run_command(["svn", "up"], cwd=self.dst, keep_output=False).check()
+            old_revision = self.revision
+            new_revision = self.info("revision")
+            if new_revision != old_revision:
+                print("Old revision: " + old_revision)
+                print("New revision: " + new_revision)
+                self.has_been_updated = old_revision != ""
+                self.revision = new_revision
+                self.changed_paths = []
+                if self.has_been_updated:
+                    self.changed_paths = self.get_changed_paths(int(old_revision) + 1, new_revision)
+                    if self.changed_paths is not None:
+                        print(str(len(self.changed_paths)) + " paths changed")
+            else:
+                self.has_been_updated = False
+                self.changed_paths = []
+
+    def last_changed_time(self):
+        # date of the last change of the checked out revision, in seconds since the epoch, None if unknown
+        # a copy of the tree without .svn asks the server for the date of its revision
+        date = self.info("last-changed-date")
+        if date == "" and self.revision != "":
+            date = self.info("last-changed-date", self.url + "@" + self.revision)
+        try:
+            return int(datetime.datetime.strptime(date[:19], "%Y-%m-%dT%H:%M:%S").replace(tzinfo=datetime.timezone.utc).timestamp())
+        except ValueError:
+            return None
+
+    def make_tgz(self, name, output = None, compressor = "auto", mtime = None):
+        # create a tar.gz (name.tar.gz by default) with a folder inside named name containing the content of self.dst,
+        # straight from self.dst and without the .svn metadata, so the working copy stays available meanwhile
+        # every entry gets the date mtime, by default the date of the last change of the revision (as SOURCE_DATE_EPOCH)
+        if output is None:
+            output = name + (".tar.zst" if compressor == "zstd" else ".tar.gz")
+        if mtime is None:
+            mtime = self.last_changed_time()
+        if mtime is None:
+            mtime = DEFAULT_TARBALL_MTIME
+        write_tarball(self.dst, name, output, compressor, mtime=mtime)
+        return output
     
-    def duplicate(self, dst):
+    def duplicate(self, dst, mode = "copy"):
+        if mode not in DUPLICATE_MODES:
+            raise ValueError("Unknown duplicate mode " + mode)
         with self.mutex:
-            launch_command("cp -r " + self.dst + " " + dst)
-            new_svn = SVN(self.url, dst)
+            if mode == "hardlink":
+                link_tree(self.dst, dst, [".svn"])
+            elif mode == "reflink":
+                run_command(["cp", "-r", "--reflink=auto", self.dst, dst], keep_output=False).check()
+            else:
+                run_command(["cp", "-r", self.dst, dst], keep_output=False).check()
+            new_svn = SVN(self.url, dst, self.excludes)
             new_svn.has_been_updated = self.has_been_updated
+            new_svn.revision = self.revision
+            new_svn.changed_paths = self.changed_paths
             return new_svn
     
-    def duplicate_and_copy_patch(self, dst, patch):
-        new_svn = self.duplicate(dst)
-        launch_command("cp -r " + patch + "/* " + dst)
+    def duplicate_and_copy_patch(self, dst, patch, mode = "copy"):
+        new_svn = self.duplicate(dst, mode)
+        if mode == "hardlink":
+            copy_over(patch, dst)
+        else:
+            run_command("cp -r " + patch + "/* " + dst, keep_output=False).check()
         return new_svn
\ No newline at end of file
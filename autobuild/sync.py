@@ -0,0 +1,85 @@
+import os
+import json
+import hashlib
+
+def file_sha1(path):
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(1024 * 1024)
+            if not chunk:
+                break
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+def scan_tree(root, previous = None):
+    # returns {relative path: [size, mtime, sha1]} for every file of root
+    # entries at the top of root starting with a dot are skipped, like the shell glob root/*
+    # the sha1 of previous is reused when the size and the mtime did not change
+    if previous is None:
+        previous = {}
+    files = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        if dirpath == root:
+            dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+            filenames = [f for f in filenames if not f.startswith(".")]
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            relpath = os.path.relpath(path, root)
+            stat = os.lstat(path)
+            size = stat.st_size
+            mtime = stat.st_mtime_ns
+            old = previous.get(relpath)
+            if old is not None and old[0] == size and old[1] == mtime:
+                files[relpath] = old
+            elif os.path.islink(path):
+                files[relpath] = [size, mtime, hashlib.sha1(os.readlink(path).encode("utf-8")).hexdigest()]
+            else:
+                files[relpath] = [size, mtime, file_sha1(path)]
+    return files
+
+def files_digest(files):
+    # digest of a {relative path: [size, mtime, sha1]} table, written on the remote tree after a push
+    sha1 = hashlib.sha1()
+    for relpath in sorted(files):
+        sha1.update((relpath + " " + files[relpath][2] + "\n").encode("utf-8"))
+    return sha1.hexdigest()
+
+def diff_trees(old, new):
+    # returns the files added or changed, and the files deleted, from old to new
+    changed = sorted([f for f in new if f not in old or old[f][2] != new[f][2]])
+    deleted = sorted([f for f in old if f not in new])
+    return changed, deleted
+
+
+class SyncManifest:
+
+    def __init__(self, path):
+        self.path = path
+        self.remote = ""
+        self.files = {}
+
+    def __str__(self):
+        return "SyncManifest: " + self.path + " -> " + self.remote
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            return False
+        try:
+            with open(self.path, "r") as f:
+                content = json.load(f)
+        except ValueError:
+            return False
+        self.remote = content["remote"]
+        self.files = content["files"]
+        return True
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + ".tmp", "w") as f:
+            json.dump({"remote": self.remote, "files": self.files}, f)
+        os.replace(self.path + ".tmp", self.path)
+
+    def invalidate(self):
+        if os.path.isfile(self.path):
+            os.remove(self.path)
@@ -0,0 +1,60 @@
+import os
+import re
+import hashlib
+
+def file_digests(path):
+    # sha1, sha256, md5 and size of path, in a single read of the file
+    sha1 = hashlib.sha1()
+    sha256 = hashlib.sha256()
+    md5 = hashlib.md5()
+    size = 0
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(1024 * 1024)
+            if not chunk:
+                break
+            sha1.update(chunk)
+            sha256.update(chunk)
+            md5.update(chunk)
+            size += len(chunk)
+    return {"sha1": sha1.hexdigest(), "sha256": sha256.hexdigest(), "md5": md5.hexdigest(), "size": size}
+
+def is_binary(data):
+    return b"\0" in data[:8192]
+
+
+class TemplateEngine:
+
+    def __init__(self, values):
+        # values: {"__VERSION__": "2.1.4", ...}, every key found in a file is replaced by its value
+        self.values = {key.encode("utf-8"): str(value).encode("utf-8") for key, value in values.items()}
+        self.expression = re.compile(b"|".join([re.escape(key) for key in sorted(self.values, key=len, reverse=True)]))
+
+    def render_file(self, path):
+        # replaces all the keys in a single read and write of path, binary files are left untouched
+        # returns True if the file changed
+        with open(path, "rb") as f:
+            data = f.read()
+        if is_binary(data):
+            return False
+        rendered = self.expression.sub(lambda match: self.values[match.group(0)], data)
+        if rendered == data:
+            return False
+        with open(path, "wb") as f:
+            f.write(rendered)
+        return True
+
+    def render_tree(self, root, skip_extensions = (".tar.gz", ".tgz"), skip_dirs = (".osc", ".svn")):
+        # returns the number of files changed under root
+        count = 0
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames[:] = [d for d in dirnames if d not in skip_dirs]
+            for filename in filenames:
+                if filename.endswith(skip_extensions):
+                    continue
+                path = os.path.join(dirpath, filename)
+                if os.path.islink(path):
+                    continue
+                if self.render_file(path):
+                    count += 1
+        return count
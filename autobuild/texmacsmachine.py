@@ -1,15 +1,27 @@
 from abc import ABC, abstractmethod
 import os
 import time
-from threading import Thread
-import logging
+import traceback
+import contextlib
+from concurrent.futures import wait
 import paramiko
 import re
+import glob
+import hashlib
 
 from autobuild.texmacsrepo import TexmacsSVN, TexmacsOBS, get_global_texmacs_svn, get_global_texmacs_obs
-from autobuild.utils import system_remote, launch_command
+from autobuild.utils import system_remote, run_command
 from autobuild.machine import Machine, MachineLock
 from autobuild.ssh import SSHHelper
+from autobuild.scheduler import get_global_scheduler, get_global_duration_history
+from autobuild.treecache import get_global_tree_cache, tree_digest
+from autobuild.registry import get_global_artifact_registry
+from autobuild.metrics import get_global_metrics
+from autobuild.logs import get_global_log_pipeline, LineBatcher
+from autobuild.svn import SVN
+
+# files of the source tree whose changes require to run ./configure again
+CONFIGURE_INPUTS = ["configure", "configure.in", "configure.ac", "Makefile.in", "src/makefile.in", "misc/m4/*.m4"]
 
 class TexmacsMachine(SSHHelper):
     
@@ -18,68 +30,168 @@ class TexmacsMachine(SSHHelper):
 
             self.name = name
             self.machine = machine
-            self.command_queue = []
+            self.scheduler = get_global_scheduler()
+            self.futures = []
+            self.build_mode = "incremental"
+            self.cpus = 1
+            self.ram = 0
+            self.patch_dir = ""
+            self.patched_dir = ""
+            self.patched_key = None
+            self.patched_held = False
+            self.configure_fingerprint = ""
             
-            self.logger = logging.getLogger("TexmacsMachine_" + self.name)
-
             # remove .log
             os.system("mkdir -p logs")
             if os.path.exists("logs/build_" + self.name + ".log"):
                 os.remove("logs/build_" + self.name + ".log")
 
-            # log into a file
-            self.logger.setLevel(logging.DEBUG)
-            self.fh = logging.FileHandler("logs/build_" + self.name + ".log")
-            self.fh.setLevel(logging.DEBUG)
-            self.logger.addHandler(self.fh)
-
-            self.thread_continue = True
-            self.thread = Thread(target=self._thread_main)
-            self.thread.start()
-        
-        def _thread_main(self):
-            while self.thread_continue:
-                if len(self.command_queue) > 0:
-                    command = self.command_queue.pop(0)
-                    command()
-                else:
-                    time.sleep(1)
+            # log into logs/build_<name>.log, through the queue of the log pipeline
+            self.log_context = {"machine": self.name, "phase": "", "revision": ""}
+            self.logger = get_global_log_pipeline().get_logger("TexmacsMachine_" + self.name, self.log_context)
         
         def join(self):
-            self.thread_continue = False
-            self.thread.join()
+            # kept for compatibility, jobs run on the shared scheduler
+            self.wait()
         
         def wait(self):
-            while len(self.command_queue) > 0:
-                time.sleep(1)
+            # returns as soon as every job queued on this machine is done
+            wait(self.futures)
         
-        def set_logger_prefix(self, prefix):
-            formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - ' + prefix + ' - %(message)s')
-            self.fh.setFormatter(formatter)
+        @contextlib.contextmanager
+        def phase(self, name):
+            # the records logged meanwhile are tagged with the phase, whose time and transfers are measured
+            self.log_context["phase"] = name
+            try:
+                with get_global_metrics().phase(self.name, name):
+                    yield
+            finally:
+                self.log_context["phase"] = ""
         
         def log_error(self, prefix, message):
-            self.set_logger_prefix(prefix)
-            self.logger.error(message)
+            self.logger.error(message, extra={"prefix": prefix})
 
         def log_warning(self, prefix, message):
-            self.set_logger_prefix(prefix)
-            self.logger.warning(message)
+            self.logger.warning(message, extra={"prefix": prefix})
 
         def log_info(self, prefix, message):
-            self.set_logger_prefix(prefix)
-            self.logger.info(message)
+            self.logger.info(message, extra={"prefix": prefix})
 
         def log_debug(self, prefix, message):
-            self.set_logger_prefix(prefix)
-            self.logger.debug(message)
+            self.logger.debug(message, extra={"prefix": prefix})
         
 
-        def system(self, command):
+        def run_system(self, command, keep_output = True):
+            # returns the CommandResult of command, with its exit code, see run_command
             current_dir = os.getcwd()
             self.log_debug("pulsar", "Launching command " + command + " in " + current_dir)
             command = command.replace("\\", "\\\\")
-            text = launch_command(command, self.logger)
-            return text
+            return run_command(command, sinks=[LineBatcher(self.logger.debug)], keep_output=keep_output, name=self.name)
+
+        def system(self, command):
+            return self.run_system(command).output
+
+        def prepare_patched_tree(self):
+            # the patched tree only depends on the svn revision and on the content of the patch directory,
+            # it is taken from the cache when they did not change
+            svn = get_global_texmacs_svn()
+            cache = get_global_tree_cache()
+            # the tree of a build whose test never ran
+            self.release_patched_tree()
+            self.patched_key = cache.key(svn.revision, self.patch_dir)
+            if self.patched_key is None:
+                self.system("mkdir -p patched")
+                self.patched_dir = "patched/" + self.name
+                self.system("rm -rf " + self.patched_dir)
+                return svn.duplicate_and_copy_patch(self.patched_dir, self.patch_dir, "hardlink")
+
+            self.patched_dir, cached = cache.get_or_build(self.patched_key, lambda path: svn.duplicate_and_copy_patch(path, self.patch_dir, "hardlink"))
+            self.patched_held = True
+            if cached:
+                self.log_info("", "Reusing patched tree " + self.patched_key + " for " + self.name)
+            return SVN(svn.url, self.patched_dir)
+
+        def release_patched_tree(self):
+            # let the cache evict the patched tree, once the machine is done with it
+            if self.patched_held:
+                self.patched_held = False
+                get_global_tree_cache().release(self.patched_key)
+
+        def get_inputs(self):
+            # everything the artifacts of this machine depend on, None if the revision is unknown
+            svn = get_global_texmacs_svn()
+            if svn.revision == "":
+                return None
+            return {"svn_revision": svn.revision, "patch": tree_digest(self.patch_dir), "version": svn.version}
+
+        def get_artifact_paths(self):
+            return ["distr/" + self.name]
+
+        def is_up_to_date(self):
+            inputs = self.get_inputs()
+            return inputs is not None and get_global_artifact_registry().is_built(self.name, inputs)
+
+        def record_artifacts(self):
+            inputs = self.get_inputs()
+            if inputs is None:
+                return
+            paths = [path for path in self.get_artifact_paths() if os.path.exists(path)]
+            get_global_artifact_registry().record(self.name, inputs, paths)
+
+        def estimate_duration(self):
+            history = get_global_duration_history()
+            return history.estimate(self.name, "build") + history.estimate(self.name, "test")
+
+        def set_resources(self, cpus, ram=0):
+            # cpus and ram (in GB) reserved on the host while building or testing
+            self.cpus = cpus
+            self.ram = ram
+
+        def set_build_mode(self, mode):
+            # incremental: configure only when its inputs changed, then make
+            # clean: push the whole tree again, configure and make from scratch
+            if mode not in ["incremental", "clean"]:
+                raise ValueError("Unknown build mode " + mode)
+            self.build_mode = mode
+
+        def sync_src_to_remote(self, dst, force = False):
+            force = force or self.build_mode == "clean"
+            if self.sync_host_to_remote(self.patched_dir, dst, "state/" + self.name + "/sync.json", force):
+                # a fresh remote tree has never been configured
+                self.forget_configure_fingerprint()
+
+        def compute_configure_fingerprint(self, configure):
+            sha1 = hashlib.sha1()
+            sha1.update(configure.encode("utf-8"))
+            for pattern in CONFIGURE_INPUTS:
+                for path in sorted(glob.glob(os.path.join(self.patched_dir, pattern))):
+                    sha1.update(os.path.relpath(path, self.patched_dir).encode("utf-8"))
+                    with open(path, "rb") as f:
+                        sha1.update(f.read())
+            return sha1.hexdigest()
+
+        def configure_commands(self, configure, clean = []):
+            # returns the commands configuring the remote tree, or nothing if it is already configured with the same inputs
+            self.configure_fingerprint = self.compute_configure_fingerprint(configure)
+            if self.build_mode == "clean":
+                return clean + [configure]
+            path = "state/" + self.name + "/configure.sha1"
+            if os.path.isfile(path):
+                with open(path, "r") as f:
+                    if f.read().strip() == self.configure_fingerprint:
+                        self.log_info("", "Configure inputs did not change, skipping configure on " + self.name)
+                        return []
+            return [configure]
+
+        def save_configure_fingerprint(self):
+            os.makedirs("state/" + self.name, exist_ok=True)
+            with open("state/" + self.name + "/configure.sha1", "w") as f:
+                f.write(self.configure_fingerprint + "\n")
+
+        def forget_configure_fingerprint(self):
+            path = "state/" + self.name + "/configure.sha1"
+            if os.path.isfile(path):
+                os.remove(path)
 
         @abstractmethod
         def duplicate_and_copy_patch(self):
@@ -102,33 +214,75 @@ class TexmacsMachine(SSHHelper):
             raise NotImplementedError
 
         def _build(self):
+            # artifacts of a previous build are no longer valid once a new build started
+            get_global_artifact_registry().forget(self.name)
+            self.log_context["revision"] = get_global_texmacs_svn().revision
             self.log_info("", "Waiting for machine " + self.name + " to be available")
-            with MachineLock(self.machine, self.ip):
+            history = get_global_duration_history()
+            metrics = get_global_metrics()
+            waited = time.time()
+            with MachineLock(self.machine, self.ip, self.cpus, self.ram, history.estimate(self.name, "build")):
+                start = time.time()
+                metrics.add(self.name, "host_wait_seconds", start - waited)
                 self.log_info("", "Building on " + self.name)
-                self.duplicate_and_copy_patch()
+                with self.phase("duplicate_and_copy_patch"):
+                    self.duplicate_and_copy_patch()
 
                 self.log_info("", "Copying src to remote on " + self.name)
-                self.copy_src_to_remote()
+                with self.phase("copy_src_to_remote"):
+                    self.copy_src_to_remote()
                 
                 self.log_info("", "Building on " + self.name)
-                self.build_package()
+                with self.phase("build_package"):
+                    self.build_package()
                 
                 self.log_info("", "Copying packages from remote on " + self.name)
-                self.copy_packages_from_remote()
+                with self.phase("copy_packages_from_remote"):
+                    self.copy_packages_from_remote()
                             
                 self.log_info("", "Done building on " + self.name)
+                history.record(self.name, "build", time.time() - start)
 
         def _test(self):
+            self.log_context["revision"] = get_global_texmacs_svn().revision
             self.log_info("", "Waiting for machine " + self.name + " to be available")
-            with MachineLock(self.machine, self.ip):
+            history = get_global_duration_history()
+            metrics = get_global_metrics()
+            waited = time.time()
+            with MachineLock(self.machine, self.ip, self.cpus, self.ram, history.estimate(self.name, "test")):
+                start = time.time()
+                metrics.add(self.name, "host_wait_seconds", start - waited)
                 self.log_info("", "Testing on " + self.name)
-                self.test_package()
+                try:
+                    with self.phase("test_package"):
+                        self.test_package()
+                finally:
+                    self.release_patched_tree()
                 self.log_info("", "Done testing on " + self.name)
+                history.record(self.name, "test", time.time() - start)
+            self.record_artifacts()
         
-        def build(self):
-            self.command_queue.append(lambda: self._build())
+        def _run_job(self, function, name):
+            try:
+                return function()
+            except Exception:
+                self.log_error(name, "Failed on " + self.name + "\n" + traceback.format_exc())
+                raise
+
+        def _submit(self, function, name, callback=None, propagate_failure=True):
+            # jobs of a same machine run one after the other, in submission order
+            after = self.futures[-1] if len(self.futures) > 0 else None
+            future = self.scheduler.submit(lambda: self._run_job(function, name), self.name + ":" + name, after, callback, propagate_failure)
+            self.futures = [f for f in self.futures if not f.done()] + [future]
+            return future
+        
+        def build(self, callback=None):
+            # a new build is not prevented by the failure of the previous jobs
+            return self._submit(self._build, "build", callback, False)
         
-        def test(self):
-            self.command_queue.append(lambda: self._test())
+        def test(self, callback=None):
+            # a test is skipped if the build before it failed
+            return self._submit(self._test, "test", callback)
+
 
 
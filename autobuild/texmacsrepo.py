@@ -1,16 +1,17 @@
 import os
-import re
 from threading import Thread, Lock
 
-from autobuild.utils import system_remote, remember_cwd
+from autobuild.utils import system_remote
 from autobuild.svn import SVN
 from autobuild.openbuildservice import OpenBuildService
+from autobuild.version import VersionScanner
 
 class TexmacsSVN(SVN):
 
-    def __init__(self, dst):
-        super().__init__("svn://svn.savannah.gnu.org/texmacs/trunk/src", dst)
+    def __init__(self, dst, excludes = []):
+        super().__init__("svn://svn.savannah.gnu.org/texmacs/trunk/src", dst, excludes)
         self.version = ""
+        self.version_scanner = VersionScanner(os.path.join(dst, "TeXmacs/doc/about/changes/change-log.en.tm"))
 
     def get_version(self):
         return self.version
@@ -23,53 +24,11 @@ class TexmacsSVN(SVN):
         super().up()
         self.version = self._parseTexmacsVersion()
     
-    def highestVersion(self, version1, version2):
-        version1_int = []
-        version2_int = []
-        # split version1 and version2 into list of integers
-        try:
-            version1_split = version1.split(".")
-            version1_int = [int(x) for x in version1_split]
-        except:
-            return version2
-
-        try:
-            version2_split = version2.split(".")
-            version2_int = [int(x) for x in version2_split]
-        except:
-            return version1
-        
-        version1_int.append(0)
-        version1_int.append(0)
-        version2_int.append(0)
-        version2_int.append(0)
-    
-        # compare each integer
-        for i in range(len(version1_int) - 2):
-            if version1_int[i] > version2_int[i]:
-                return version1
-            elif version1_int[i] < version2_int[i]:
-                return version2
-        # if we reach this point, version1 == version2
-        return version1
-
     def _parseTexmacsVersion(self):
-        with self.mutex:
-            file_content = ""
-            with remember_cwd():
-                os.chdir(self.dst)
-                # open TeXmacs/doc/about/changes/change-log.en.tm
-                with open("TeXmacs/doc/about/changes/change-log.en.tm", "r", encoding='latin-1') as f:
-                    file_content = f.read()
-            # some lines may contains (2.1.2) or (2.1)
-            # we want to extract 2.1.2
-            expression = re.compile(r"\((\d+\.\d+(\.\d+)?)\)")
-            matches = expression.findall(file_content)
-            version = "0.0.0"
-            for match in matches:
-                version = self.highestVersion(version, match[0])
-            print("TeXmacs version: " + version)
-            return version
+        # does not need the mutex, the scanner only reads the change log
+        version = self.version_scanner.get_version()
+        print("TeXmacs version: " + version)
+        return version
 
 class TexmacsOBS(OpenBuildService):
 
@@ -84,9 +43,8 @@ def get_global_texmacs_svn():
         global texmacs_svn
         if texmacs_svn is None:
             os.system("mkdir -p repos")
-            os.system("rm -rf repos/texmacs")
             texmacs_svn = TexmacsSVN("repos/texmacs")
-            texmacs_svn.co()
+            texmacs_svn.co_or_up()
         return texmacs_svn
 
 texmacs_obs = None
@@ -2,6 +2,7 @@ import datetime
 import os
 import contextlib, os
 import time
+import hashlib
 from threading import Thread
 
 @contextlib.contextmanager
@@ -10,6 +11,23 @@ def remember_cwd():
     try: yield
     finally: os.chdir(curdir)
 
+def file_digests(path):
+    # sha1, sha256, md5 and size of path, in a single read of the file
+    sha1 = hashlib.sha1()
+    sha256 = hashlib.sha256()
+    md5 = hashlib.md5()
+    size = 0
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(1024 * 1024)
+            if not chunk:
+                break
+            sha1.update(chunk)
+            sha256.update(chunk)
+            md5.update(chunk)
+            size += len(chunk)
+    return {"sha1": sha1.hexdigest(), "sha256": sha256.hexdigest(), "md5": md5.hexdigest(), "size": size}
+
 def launch_command(command):
     print(command)
     return os.popen(command).read()
@@ -114,15 +132,12 @@ class OpenBuildService:
             filename = os.path.basename(dst_dsc_path)
             os.chdir(path)
 
-            # compute checksums
-            checksums_sha1 = launch_command("sha1sum " + file_to_update)
-            checksums_sha1 = checksums_sha1.split(" ")[0]
-            checksums_sha256 = launch_command("sha256sum " + file_to_update)
-            checksums_sha256 = checksums_sha256.split(" ")[0]
-            md5sum = launch_command("md5sum " + file_to_update)
-            md5sum = md5sum.split(" ")[0]
-            file_size = launch_command("stat -c %s " + file_to_update)
-            file_size = file_size.replace("\n", "")
+            # compute checksums, in a single pass over the file
+            checksums = file_digests(file_to_update)
+            checksums_sha1 = checksums["sha1"]
+            checksums_sha256 = checksums["sha256"]
+            md5sum = checksums["md5"]
+            file_size = str(checksums["size"])
 
             # update dsc file
             with open(filename, "r") as f:
@@ -0,0 +1,154 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+from threading import Lock
+
+from autobuild.sync import scan_tree
+
+def tree_digest(path):
+    # digest of the names and contents of the files of path
+    sha1 = hashlib.sha1()
+    files = scan_tree(path)
+    for relpath in sorted(files):
+        sha1.update((relpath + " " + files[relpath][2] + "\n").encode("utf-8"))
+    return sha1.hexdigest()
+
+def disk_usage(path):
+    # files hard linked from elsewhere only count for their share
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            stat = os.lstat(os.path.join(dirpath, filename))
+            size += stat.st_size // max(stat.st_nlink, 1)
+    return size
+
+
+class TreeCache:
+
+    def __init__(self, root = "cache/patched", budget = 20 * 1024 * 1024 * 1024):
+        self.root = root
+        self.budget = budget
+        # number of machines using each tree, these trees are not evicted
+        self.used = {}
+        self.locks = {}
+        self.mutex = Lock()
+
+    def __str__(self):
+        return "TreeCache: " + self.root
+
+    def key(self, revision, patch):
+        # None when the revision is unknown, such a tree cannot be cached
+        if revision == "":
+            return None
+        return revision + "-" + tree_digest(patch)[:16]
+
+    def entry_path(self, key):
+        return os.path.join(self.root, key)
+
+    def tree_path(self, key):
+        return os.path.join(self.root, key, "tree")
+
+    def get_lock(self, key):
+        with self.mutex:
+            if key not in self.locks:
+                self.locks[key] = Lock()
+            return self.locks[key]
+
+    def get_meta(self, key):
+        path = os.path.join(self.entry_path(key), "meta.json")
+        if not os.path.isfile(path):
+            return None
+        try:
+            with open(path, "r") as f:
+                return json.load(f)
+        except ValueError:
+            return None
+
+    def _write_meta(self, key, meta):
+        path = os.path.join(self.entry_path(key), "meta.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(meta, f, indent=1)
+        os.replace(path + ".tmp", path)
+
+    def update(self, key, **fields):
+        # store fields (checksums, ...) along with the tree, and account for the files added to the entry
+        with self.get_lock(key):
+            meta = self.get_meta(key)
+            meta.update(fields)
+            meta["size"] = disk_usage(self.entry_path(key))
+            self._write_meta(key, meta)
+        self.evict()
+
+    def get_or_build(self, key, build):
+        # returns the path of the tree for key, calling build(path) to create it if it is not cached
+        # returns True as second value if the tree was already cached
+        # the tree is kept until release(key)
+        with self.get_lock(key):
+            # held before looking at the entry, so that it can not be evicted meanwhile
+            self.hold(key)
+            meta = self.get_meta(key)
+            if meta is not None and os.path.isdir(self.tree_path(key)):
+                meta["last_used"] = time.time()
+                self._write_meta(key, meta)
+                return self.tree_path(key), True
+
+            try:
+                shutil.rmtree(self.entry_path(key), ignore_errors=True)
+                os.makedirs(self.entry_path(key))
+                build(self.tree_path(key))
+                now = time.time()
+                self._write_meta(key, {"created": now, "last_used": now, "size": disk_usage(self.entry_path(key))})
+            except Exception:
+                self.release(key)
+                raise
+        self.evict()
+        return self.tree_path(key), False
+
+    def hold(self, key):
+        with self.mutex:
+            self.used[key] = self.used.get(key, 0) + 1
+
+    def release(self, key):
+        with self.mutex:
+            if self.used.get(key, 0) <= 1:
+                self.used.pop(key, None)
+            else:
+                self.used[key] -= 1
+        self.evict()
+
+    def evict(self):
+        # remove the least recently used entries until the cache fits in its budget
+        # entries in use are kept
+        with self.mutex:
+            if not os.path.isdir(self.root):
+                return
+            entries = []
+            total = 0
+            for key in os.listdir(self.root):
+                meta = self.get_meta(key)
+                if meta is None:
+                    continue
+                entries.append((meta["last_used"], key, meta["size"]))
+                total += meta["size"]
+            for last_used, key, size in sorted(entries):
+                if total <= self.budget:
+                    break
+                if key in self.used:
+                    continue
+                print("Evicting " + key + " from " + self.root)
+                shutil.rmtree(self.entry_path(key), ignore_errors=True)
+                total -= size
+
+
+tree_cache = None
+tree_cache_mutex = Lock()
+
+def get_global_tree_cache():
+    global tree_cache_mutex
+    with tree_cache_mutex:
+        global tree_cache
+        if tree_cache is None:
+            tree_cache = TreeCache()
+        return tree_cache
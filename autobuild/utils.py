@@ -1,8 +1,17 @@
 import os
+import time
+import socket
 import contextlib
 from threading import Thread
 import subprocess
-import paramiko
+import shutil
+import tarfile
+import gzip
+import codecs
+import collections
+
+from autobuild.metrics import get_global_metrics
+from autobuild.logs import LineBatcher
 
 @contextlib.contextmanager
 def remember_cwd():
@@ -10,19 +19,229 @@ def remember_cwd():
     try: yield
     finally: os.chdir(curdir)
 
-def launch_command(command, logger = None):
-    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=True)
-    outputs = []
+class CommandError(Exception):
+
+    def __init__(self, command, returncode, tail):
+        super().__init__("Command " + str(command) + " failed with exit code " + str(returncode) + "\n" + "\n".join(tail))
+        self.command = command
+        self.returncode = returncode
+        self.tail = tail
+
+
+class CommandResult:
+
+    def __init__(self, command, returncode, duration, output, tail):
+        self.command = command
+        self.returncode = returncode
+        self.duration = duration
+        # output is None when the command ran with keep_output = False, tail holds its last lines
+        self.output = output
+        self.tail = tail
+
+    def __str__(self):
+        return "CommandResult: " + str(self.command) + " -> " + str(self.returncode)
+
+    def check(self, accepted = [0]):
+        if self.returncode not in accepted:
+            raise CommandError(self.command, self.returncode, self.tail)
+        return self
+
+
+class FileSink:
+    # writes the output lines into a file
+
+    def __init__(self, path):
+        self.file = open(path, "w", encoding="utf-8")
+
+    def add(self, line):
+        self.file.write(line + "\n")
+
+    def flush(self):
+        self.file.close()
+
+
+class TailSink:
+    # keeps the last size lines of the output
+
+    def __init__(self, size = 50):
+        self.lines = collections.deque(maxlen=size)
+
+    def add(self, line):
+        self.lines.append(line)
+
+    def flush(self):
+        pass
+
+
+class ListSink:
+    # keeps the whole output
+
+    def __init__(self):
+        self.lines = []
+
+    def add(self, line):
+        self.lines.append(line)
+
+    def flush(self):
+        pass
+
+
+def run_command(command, cwd = None, sinks = [], keep_output = True, tail = 50, name = ""):
+    # run command, a list of arguments, or a string run by the shell, and stream its output line by line to sinks
+    # (objects with add(line) and flush(), such as LineBatcher(logger.debug), FileSink, TailSink)
+    # without keep_output, only the last tail lines are kept in memory
+    # cwd is the directory the command runs in, the current directory of the process is never changed
+    # name is the machine the command is counted for in the metrics
+    get_global_metrics().add(name, "subprocesses")
+    start = time.time()
+    tail_sink = TailSink(tail)
+    sinks = list(sinks) + [tail_sink]
+    list_sink = None
+    if keep_output:
+        list_sink = ListSink()
+        sinks.append(list_sink)
+
+    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=isinstance(command, str), cwd=cwd)
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    pending = ""
+    fd = p.stdout.fileno()
     while True:
-        line = p.stdout.readline()
-        if not line:
+        data = os.read(fd, 65536)
+        final = len(data) == 0
+        pending += decoder.decode(data, final)
+        lines = pending.split("\n")
+        pending = "" if final else lines.pop()
+        for line in lines:
+            if final and line == "":
+                continue
+            line = line.rstrip()
+            for sink in sinks:
+                sink.add(line)
+        if final:
             break
-        line = line.rstrip()
-        line = line.decode("utf-8")
-        if logger is not None:
-            logger.debug(line)
-        outputs.append(line)
-    return "\n".join(outputs)
+    p.stdout.close()
+    returncode = p.wait()
+    for sink in sinks:
+        sink.flush()
+
+    output = "\n".join(list_sink.lines) if list_sink is not None else None
+    return CommandResult(command, returncode, time.time() - start, output, list(tail_sink.lines))
+
+def launch_command(command, logger = None, cwd = None):
+    # returns the whole output of command, see run_command
+    sinks = [LineBatcher(logger.debug)] if logger is not None else []
+    return run_command(command, cwd, sinks).output
 
 def system_remote(command, remote, username, logger = None):
     return launch_command("ssh " + username + "@" + remote + " " + command, logger)
+
+def wait_for_ssh(ip, port = 22, timeout = 600):
+    # wait until an ssh server sends its banner on ip:port, polling with an exponential backoff from 0.2 to 5 seconds
+    # returns False on timeout
+    start = time.time()
+    delay = 0.2
+    while True:
+        try:
+            with socket.create_connection((ip, port), timeout=2) as s:
+                s.settimeout(2)
+                if s.recv(256).startswith(b"SSH-"):
+                    return True
+        except OSError:
+            pass
+        if time.time() - start > timeout:
+            return False
+        time.sleep(delay)
+        delay = min(delay * 2, 5)
+
+def link_tree(src, dst, exclude = []):
+    # recreate the directories of src in dst, with hard links to the files of src
+    # files that cannot be linked (other file system) are copied
+    for dirpath, dirnames, filenames in os.walk(src):
+        target = os.path.join(dst, os.path.relpath(dirpath, src))
+        os.makedirs(target, exist_ok=True)
+        for dirname in list(dirnames):
+            if dirname in exclude:
+                dirnames.remove(dirname)
+            elif os.path.islink(os.path.join(dirpath, dirname)):
+                os.symlink(os.readlink(os.path.join(dirpath, dirname)), os.path.join(target, dirname))
+                dirnames.remove(dirname)
+        for filename in filenames:
+            source = os.path.join(dirpath, filename)
+            if os.path.islink(source):
+                os.symlink(os.readlink(source), os.path.join(target, filename))
+                continue
+            try:
+                os.link(source, os.path.join(target, filename))
+            except OSError:
+                shutil.copy2(source, os.path.join(target, filename))
+
+def copy_over(src, dst):
+    # copy the content of src over dst, like cp -r src/* dst
+    # existing files are replaced, not written into, so that hard links to them are left untouched
+    for dirpath, dirnames, filenames in os.walk(src):
+        if dirpath == src:
+            dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+            filenames = [f for f in filenames if not f.startswith(".")]
+        target = os.path.join(dst, os.path.relpath(dirpath, src))
+        os.makedirs(target, exist_ok=True)
+        for filename in filenames:
+            destination = os.path.join(target, filename)
+            if os.path.lexists(destination):
+                os.remove(destination)
+            shutil.copy2(os.path.join(dirpath, filename), destination, follow_symlinks=False)
+
+# 1980-01-01, the earliest date zip files can hold, for trees whose date is unknown
+DEFAULT_TARBALL_MTIME = 315532800
+
+def _tar_tree(tar, src, arcname, exclude, mtime):
+    # add src to tar under arcname, in sorted order, with fixed owners and mtimes
+    def normalize(info):
+        info.mtime = mtime
+        info.uid = 0
+        info.gid = 0
+        info.uname = ""
+        info.gname = ""
+        return info
+    for dirpath, dirnames, filenames in os.walk(src):
+        dirnames[:] = sorted([d for d in dirnames if d not in exclude])
+        relpath = os.path.relpath(dirpath, src)
+        prefix = arcname if relpath == "." else arcname + "/" + relpath.replace(os.sep, "/")
+        tar.addfile(normalize(tar.gettarinfo(dirpath, prefix)))
+        for name in sorted(dirnames + filenames):
+            path = os.path.join(dirpath, name)
+            if name in dirnames and not os.path.islink(path):
+                continue
+            if name in exclude:
+                continue
+            info = normalize(tar.gettarinfo(path, prefix + "/" + name))
+            if info.isreg():
+                with open(path, "rb") as f:
+                    tar.addfile(info, f)
+            else:
+                tar.addfile(info)
+
+def write_tarball(src, arcname, output, compressor = "auto", exclude = [".svn"], mtime = DEFAULT_TARBALL_MTIME):
+    # write output, a compressed tar of the content of src inside a folder named arcname
+    # the archive only depends on the content of src and on mtime, the date given to every entry,
+    # so its checksums are the same from one run to the other
+    # compressor: gzip (python), pigz (parallel gzip), zstd (parallel zstd), auto (pigz if available, gzip otherwise)
+    if compressor == "auto":
+        compressor = "pigz" if shutil.which("pigz") is not None else "gzip"
+    with open(output, "wb") as f:
+        if compressor == "gzip":
+            with gzip.GzipFile(filename="", mode="wb", fileobj=f, compresslevel=6, mtime=0) as stream:
+                with tarfile.open(fileobj=stream, mode="w|", format=tarfile.GNU_FORMAT) as tar:
+                    _tar_tree(tar, src, arcname, exclude, mtime)
+            return
+        if compressor == "pigz":
+            command = ["pigz", "-n", "-6", "-c"]
+        elif compressor == "zstd":
+            command = ["zstd", "-T0", "-q", "-c"]
+        else:
+            raise ValueError("Unknown compressor " + compressor)
+        p = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=f)
+        with tarfile.open(fileobj=p.stdin, mode="w|", format=tarfile.GNU_FORMAT) as tar:
+            _tar_tree(tar, src, arcname, exclude, mtime)
+        p.stdin.close()
+        if p.wait() != 0:
+            raise RuntimeError(compressor + " failed with exit code " + str(p.returncode))
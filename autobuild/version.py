@@ -0,0 +1,104 @@
+import os
+import re
+import json
+import hashlib
+from threading import Lock
+
+# some lines may contains (2.1.2) or (2.1), we want to extract 2.1.2
+VERSION_EXPRESSION = re.compile(rb"\((\d+\.\d+(?:\.\d+)?)\)")
+
+# bytes of the file compared to know if it only grew at its beginning or at its end
+ANCHOR_SIZE = 4096
+# bytes scanned again before the new part, in case a version was cut at the boundary
+OVERLAP_SIZE = 64
+
+def version_key(version):
+    # "2.1" -> (2, 1, 0), to compare versions as tuples
+    try:
+        numbers = [int(x) for x in version.split(".")]
+    except ValueError:
+        return None
+    return tuple(numbers + [0] * (3 - len(numbers)))
+
+def highest_version(data, version = "0.0.0"):
+    # returns the highest of version and of the versions found in data
+    key = version_key(version)
+    for match in VERSION_EXPRESSION.finditer(data):
+        candidate = match.group(1).decode("ascii")
+        candidate_key = version_key(candidate)
+        if candidate_key > key:
+            version = candidate
+            key = candidate_key
+    return version
+
+def read_at(f, offset, size):
+    f.seek(offset)
+    return f.read(size)
+
+def anchor_digest(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+class VersionScanner:
+    # highest version found in a change log, remembered in state_path with the size and mtime of the log
+    # when the log only grew, at its beginning or at its end, only the new part is scanned
+
+    def __init__(self, path, state_path = "state/version.json"):
+        self.path = path
+        self.state_path = state_path
+        self.state = None
+        self.mutex = Lock()
+
+    def __str__(self):
+        return "VersionScanner: " + self.path
+
+    def load(self):
+        if self.state is not None or not os.path.isfile(self.state_path):
+            return
+        try:
+            with open(self.state_path, "r") as f:
+                self.state = json.load(f)
+        except ValueError:
+            self.state = None
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+        with open(self.state_path + ".tmp", "w") as f:
+            json.dump(self.state, f, indent=1)
+        os.replace(self.state_path + ".tmp", self.state_path)
+
+    def get_anchors(self, f, size):
+        head = min(ANCHOR_SIZE, size)
+        tail = min(ANCHOR_SIZE, size)
+        return anchor_digest(read_at(f, 0, head)), anchor_digest(read_at(f, size - tail, tail))
+
+    def scan(self, f, size):
+        # returns the highest version of the file, scanning only what is new since the last scan if possible
+        old = self.state
+        if old is not None and old["path"] == self.path and size > old["size"]:
+            grown = size - old["size"]
+            head = min(ANCHOR_SIZE, old["size"])
+            tail = min(ANCHOR_SIZE, old["size"])
+            # appended at the end
+            if anchor_digest(read_at(f, 0, head)) == old["head"] and anchor_digest(read_at(f, old["size"] - tail, tail)) == old["tail"]:
+                start = max(0, old["size"] - OVERLAP_SIZE)
+                return highest_version(read_at(f, start, size - start), old["version"])
+            # inserted at the beginning
+            if anchor_digest(read_at(f, grown, head)) == old["head"] and anchor_digest(read_at(f, size - tail, tail)) == old["tail"]:
+                return highest_version(read_at(f, 0, grown + OVERLAP_SIZE), old["version"])
+        return highest_version(read_at(f, 0, size))
+
+    def get_version(self):
+        with self.mutex:
+            self.load()
+            stat = os.stat(self.path)
+            old = self.state
+            if old is not None and old["path"] == self.path and old["size"] == stat.st_size and old["mtime"] == stat.st_mtime_ns:
+                return old["version"]
+
+            with open(self.path, "rb") as f:
+                version = self.scan(f, stat.st_size)
+                head, tail = self.get_anchors(f, stat.st_size)
+            self.state = {"path": self.path, "size": stat.st_size, "mtime": stat.st_mtime_ns, "head": head, "tail": tail, "version": version}
+            self.save()
+            return version
@@ -0,0 +1,22 @@
+import logging
+import os
+
+from autobuild.logs import LogPipeline
+
+def test_failing_subscriber_does_not_stop_the_pipeline(tmp_path, monkeypatch):
+    monkeypatch.setattr(logging, "raiseExceptions", False)
+    pipeline = LogPipeline(str(tmp_path))
+    lines = []
+    def failing(line):
+        raise ValueError("subscriber failed")
+    pipeline.subscribe(None, failing)
+    pipeline.subscribe("machine", lines.append)
+    logger = pipeline.get_logger("test_logs", {"machine": "machine", "phase": "", "revision": ""})
+    logger.info("first")
+    logger.info("second")
+    pipeline.stop()
+    assert len(lines) == 2
+    assert pipeline.live.subscribers == [("machine", lines.append)]
+    with open(os.path.join(str(tmp_path), "build_machine.log")) as f:
+        content = f.read()
+    assert "first" in content and "second" in content
@@ -0,0 +1,35 @@
+import autobuild.openbuildservice as openbuildservice
+from autobuild.openbuildservice import OpenBuildService, parse_results, failed_results
+
+RESULTS = """openSUSE_Tumbleweed  x86_64     succeeded
+Debian_11            i586       building
+xUbuntu_22.04        x86_64     failed*
+Fedora_38            aarch64    TeXmacs-QT5  unresolvable: nothing provides qt5
+Fedora_38            x86_64     (disabled)
+Some text without a state
+"""
+
+def test_parse_results():
+    assert parse_results(RESULTS) == {
+        "openSUSE_Tumbleweed/x86_64": "succeeded",
+        "Debian_11/i586": "building",
+        "xUbuntu_22.04/x86_64": "failed",
+        "Fedora_38/aarch64/TeXmacs-QT5": "unresolvable",
+        "Fedora_38/x86_64": "disabled",
+    }
+
+def test_failed_results():
+    assert failed_results(parse_results(RESULTS)) == ["Fedora_38/aarch64/TeXmacs-QT5", "xUbuntu_22.04/x86_64"]
+
+def test_wait_for_results_backoff(monkeypatch):
+    tables = [{"a/x86_64": "building"}] * 20 + [{"a/x86_64": "succeeded"}]
+    obs = OpenBuildService("project", "dst")
+    monkeypatch.setattr(obs, "get_results_table", lambda logger=None: tables.pop(0))
+    delays = []
+    monkeypatch.setattr(openbuildservice.time, "sleep", delays.append)
+    assert obs.wait_for_results() == {"a/x86_64": "succeeded"}
+    assert len(delays) == 20
+    assert delays[0] == 10
+    # the delay grows while nothing changes, never above one minute
+    assert delays == sorted(delays)
+    assert max(delays) == 60
@@ -0,0 +1,38 @@
+import os
+
+import autobuild.registry as registry
+from autobuild.registry import ArtifactRegistry
+
+def test_is_built(tmp_path, monkeypatch):
+    artifacts = tmp_path / "distr" / "machine"
+    artifacts.mkdir(parents=True)
+    (artifacts / "package").write_text("binary")
+    reg = ArtifactRegistry(str(tmp_path / "distr" / "registry.json"))
+    inputs = {"svn_revision": "1"}
+    assert not reg.is_built("machine", inputs)
+    reg.record("machine", inputs, [str(artifacts)])
+    assert ArtifactRegistry(reg.path).is_built("machine", inputs)
+    assert not reg.is_built("machine", {"svn_revision": "2"})
+
+def test_unchanged_files_are_not_hashed(tmp_path, monkeypatch):
+    path = tmp_path / "package"
+    path.write_text("binary")
+    reg = ArtifactRegistry(str(tmp_path / "registry.json"))
+    reg.record("machine", {}, [str(path)])
+    hashed = []
+    monkeypatch.setattr(registry, "file_sha1", lambda filename: hashed.append(filename))
+    assert reg.is_built("machine", {})
+    assert hashed == []
+
+def test_touched_files_are_hashed(tmp_path):
+    path = tmp_path / "package"
+    path.write_text("binary")
+    reg = ArtifactRegistry(str(tmp_path / "registry.json"))
+    reg.record("machine", {}, [str(path)])
+    stat = os.stat(str(path))
+    os.utime(str(path), ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+    assert reg.is_built("machine", {})
+    # same size, other content
+    path.write_text("BINARY")
+    os.utime(str(path), ns=(stat.st_atime_ns, stat.st_mtime_ns + 2000000000))
+    assert not reg.is_built("machine", {})
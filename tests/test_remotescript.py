@@ -0,0 +1,65 @@
+import subprocess
+
+from autobuild.remotescript import make_script, ScriptOutput
+
+def run_script(commands, stop_on_error=True, keep_output=True, tail=50):
+    script = "\n".join(make_script(commands, stop_on_error)) + "\n"
+    p = subprocess.run(["bash"], input=script.encode("utf-8"), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = ScriptOutput(commands, keep_output, tail)
+    for line in p.stdout.decode("utf-8").splitlines():
+        output.add(line)
+    return output.finish()
+
+def test_steps_output_and_exit_codes():
+    results = run_script(["echo one", "echo two; echo three", "true"])
+    assert [(command, text, exit_code) for command, text, exit_code, duration in results] == [
+        ("echo one", "one", 0),
+        ("echo two; echo three", "two\nthree", 0),
+        ("true", "", 0),
+    ]
+
+def test_stop_on_error_skips_following_steps():
+    results = run_script(["echo before", "exit_with() { return $1; }; exit_with 3", "echo after"])
+    assert [exit_code for command, text, exit_code, duration in results] == [0, 3, None]
+    assert results[2][1] == ""
+
+def test_without_stop_on_error_every_step_runs():
+    results = run_script(["false", "echo after"], stop_on_error=False)
+    assert [(text, exit_code) for command, text, exit_code, duration in results] == [("", 1), ("after", 0)]
+
+def test_steps_share_the_shell_and_do_not_read_the_script():
+    results = run_script(["cd /", "export AUTOBUILD_TEST=value", "cat", "echo $PWD $AUTOBUILD_TEST # comment"])
+    assert [exit_code for command, text, exit_code, duration in results] == [0, 0, 0, 0]
+    assert results[2][1] == ""
+    assert results[3][1] == "/ value"
+
+def test_tail_only_without_keep_output():
+    results = run_script(["seq 1 1000"], keep_output=False, tail=3)
+    assert results[0][1] == "998\n999\n1000"
+
+def test_echoed_script_is_not_taken_for_markers():
+    commands = ["make"]
+    output = ScriptOutput(commands)
+    # the terminal echoes the script before running it
+    for line in make_script(commands):
+        output.add(line)
+    output.add("make: Nothing to be done")
+    output.add("+++STEP+++ 0 2")
+    results = output.finish()
+    assert results[0][2] == 2
+    assert results[0][1].endswith("make: Nothing to be done")
+
+def test_missing_and_unexpected_markers():
+    output = ScriptOutput(["a", "b"])
+    output.add("+++STEP+++ 1 0")
+    output.add("+++STEP+++ 0 0")
+    output.add("+++STEP+++ 5 0")
+    results = output.finish()
+    assert results[0][1] == "+++STEP+++ 1 0"
+    assert results[1] == ("b", "+++STEP+++ 5 0", None, 0)
+
+def test_environment_does_not_leak_out_of_the_script():
+    commands = ["cd /", "export AUTOBUILD_TEST=value"]
+    script = "\n".join(make_script(commands)) + "\necho after $PWD $AUTOBUILD_TEST\n"
+    p = subprocess.run(["bash"], input=script.encode("utf-8"), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd="/tmp")
+    assert p.stdout.decode("utf-8").splitlines()[-1].rstrip() == "after /tmp"
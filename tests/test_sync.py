@@ -0,0 +1,50 @@
+import os
+
+from autobuild.sync import scan_tree, diff_trees, files_digest, SyncManifest
+
+def test_diff_trees():
+    old = {"a": [1, 10, "sha_a"], "b": [1, 10, "sha_b"], "c": [1, 10, "sha_c"]}
+    new = {"a": [1, 20, "sha_a"], "b": [2, 20, "sha_b2"], "d": [1, 20, "sha_d"]}
+    # a was only touched, its content did not change
+    assert diff_trees(old, new) == (["b", "d"], ["c"])
+    assert diff_trees({}, new) == (["a", "b", "d"], [])
+    assert diff_trees(new, new) == ([], [])
+
+def test_scan_tree(tmp_path):
+    root = tmp_path / "tree"
+    (root / "src").mkdir(parents=True)
+    (root / "src" / "file").write_text("content")
+    (root / ".svn").mkdir()
+    (root / ".svn" / "entries").write_text("svn")
+    (root / ".hidden").write_text("hidden")
+    (root / "src" / ".kept").write_text("kept")
+    files = scan_tree(str(root))
+    assert sorted(files) == [os.path.join("src", ".kept"), os.path.join("src", "file")]
+
+def test_scan_tree_reuses_previous_digests(tmp_path):
+    root = tmp_path / "tree"
+    root.mkdir()
+    (root / "file").write_text("content")
+    files = scan_tree(str(root))
+    previous = {"file": files["file"][:2] + ["cached"]}
+    assert scan_tree(str(root), previous)["file"][2] == "cached"
+
+def test_manifest_roundtrip(tmp_path):
+    path = str(tmp_path / "state" / "sync.json")
+    manifest = SyncManifest(path)
+    assert not manifest.load()
+    manifest.remote = "user@host:dst"
+    manifest.files = {"a": [1, 10, "sha"]}
+    manifest.save()
+    loaded = SyncManifest(path)
+    assert loaded.load()
+    assert loaded.remote == "user@host:dst" and loaded.files == manifest.files
+    loaded.invalidate()
+    assert not SyncManifest(path).load()
+
+def test_files_digest():
+    files = {"a": [1, 10, "sha_a"], "b": [1, 10, "sha_b"]}
+    # only the names and contents matter
+    assert files_digest(files) == files_digest({"b": [1, 30, "sha_b"], "a": [2, 20, "sha_a"]})
+    assert files_digest(files) != files_digest({"a": [1, 10, "sha_a"]})
+    assert files_digest(files) != files_digest({"a": [1, 10, "sha_a"], "b": [1, 10, "sha_c"]})
@@ -0,0 +1,73 @@
+import os
+
+from autobuild.version import VersionScanner, version_key, highest_version, ANCHOR_SIZE
+
+def write(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
+    # make sure the change is seen even if the clock did not move
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+
+def test_version_key():
+    assert version_key("2.1") == (2, 1, 0)
+    assert version_key("2.1.4") == (2, 1, 4)
+    assert version_key("1.99.20") < version_key("2.1")
+    assert version_key("2.1") == version_key("2.1.0")
+
+def test_highest_version():
+    assert highest_version(b"(1.99.20) (2.1) (2.0.3) (not) (3)") == "2.1"
+    assert highest_version(b"nothing") == "0.0.0"
+    assert highest_version(b"(2.1)", "2.2") == "2.2"
+
+def test_cached_when_unchanged(tmp_path):
+    log = str(tmp_path / "log")
+    write(log, b"(2.1)")
+    scanner = VersionScanner(log, str(tmp_path / "state.json"))
+    assert scanner.get_version() == "2.1"
+    # the state is read back by a new scanner, without reading the log
+    scanner = VersionScanner(log, str(tmp_path / "state.json"))
+    scanner.scan = None
+    assert scanner.get_version() == "2.1"
+
+def test_appended_part_only(tmp_path):
+    log = str(tmp_path / "log")
+    body = b"x" * (3 * ANCHOR_SIZE) + b"(2.1)\n" + b"y" * (3 * ANCHOR_SIZE)
+    write(log, body)
+    scanner = VersionScanner(log, str(tmp_path / "state.json"))
+    assert scanner.get_version() == "2.1"
+    # a higher version in the old part would be found by a full scan only
+    with open(log, "r+b") as f:
+        f.seek(2 * ANCHOR_SIZE)
+        f.write(b"(9.9)")
+    with open(log, "ab") as f:
+        f.write(b"(2.1.4)")
+    write(log, open(log, "rb").read())
+    assert scanner.get_version() == "2.1.4"
+
+def test_version_cut_at_the_boundary(tmp_path):
+    log = str(tmp_path / "log")
+    write(log, b"x" * (2 * ANCHOR_SIZE) + b"(2.")
+    scanner = VersionScanner(log, str(tmp_path / "state.json"))
+    assert scanner.get_version() == "0.0.0"
+    write(log, open(log, "rb").read() + b"1.4)")
+    assert scanner.get_version() == "2.1.4"
+
+def test_prepended_part(tmp_path):
+    log = str(tmp_path / "log")
+    body = b"x" * (3 * ANCHOR_SIZE) + b"(2.1)"
+    write(log, body)
+    scanner = VersionScanner(log, str(tmp_path / "state.json"))
+    assert scanner.get_version() == "2.1"
+    write(log, b"(3.0)\n" + body)
+    assert scanner.get_version() == "3.0"
+
+def test_rewritten_log_is_scanned_again(tmp_path):
+    log = str(tmp_path / "log")
+    write(log, b"(2.1) " + b"x" * (3 * ANCHOR_SIZE))
+    scanner = VersionScanner(log, str(tmp_path / "state.json"))
+    assert scanner.get_version() == "2.1"
+    write(log, b"(1.0) " + b"x" * (3 * ANCHOR_SIZE) + b"more")
+    assert scanner.get_version() == "1.0"
+    write(log, b"(1.5) " + b"x" * (3 * ANCHOR_SIZE) + b"more")
+    assert scanner.get_version() == "1.5"